@@ -0,0 +1,82 @@
+"""bench_import.py
+Time a cold import of each mdb_tools module (in a fresh interpreter each time), and list the heavy optional
+dependencies that the import pulls in.
+
+Example usage (from the repository root):
+python benchmarks/bench_import.py --repeats 5 --out import_results.csv
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import pandas as pd
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+MODULES = ["mdb_tools.instrument", "mdb_tools.loop_stats", "mdb_tools.load_data", "mdb_tools.schemas",
+           "mdb_tools.live", "mdb_tools.mirror", "mdb_tools.query", "mdb_tools.batch", "mdb_tools.sugar_plots",
+           "mdb_tools.synthetic"]
+
+# Dependencies that should only be imported when they are used
+HEAVY_MODULES = ["pymongo", "pymongoarrow", "yaml", "pyarrow", "matplotlib", "seaborn", "bson"]
+
+# Run in the fresh interpreter: import the module, then report the time taken and what got imported
+_PROBE = """
+import json, sys, time, warnings
+warnings.simplefilter("ignore")
+t_start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - t_start
+print(json.dumps({{"seconds": seconds, "loaded": [name for name in {heavy} if name in sys.modules]}}))
+"""
+
+
+def time_import(module, repeats=5):
+    """
+    Import a module in a fresh interpreter a few times
+
+    Returns: (tuple) best import time (seconds) and the list of heavy modules that the import loaded
+
+    """
+    best, loaded = float("inf"), []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if result["seconds"] < best:
+            best, loaded = result["seconds"], result["loaded"]
+
+    return best, loaded
+
+
+def run(modules=MODULES, repeats=5):
+    """
+    Time the import of every module
+
+    Returns: pandas dataframe with one row per module: seconds and the heavy modules loaded
+
+    """
+    baseline, _ = time_import("pandas", repeats)
+    print("%-24s %8.1f ms" % ("pandas (baseline)", baseline * 1000))
+
+    results = []
+    for module in modules:
+        seconds, loaded = time_import(module, repeats)
+        results.append({"module": module, "seconds": seconds, "loaded": " ".join(loaded)})
+        print("%-24s %8.1f ms   %s" % (module, seconds * 1000, " ".join(loaded)))
+
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=MODULES, help="modules to import")
+    parser.add_argument("--repeats", type=int, default=5, help="imports per module (the fastest is kept)")
+    parser.add_argument("--out", default=None, help="write the results to this csv file")
+    args = parser.parse_args()
+
+    df_results = run(args.modules, args.repeats)
+    if args.out is not None:
+        df_results.to_csv(args.out, index=False)
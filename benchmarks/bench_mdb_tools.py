@@ -0,0 +1,142 @@
+"""bench_mdb_tools.py
+Time and memory-profile the public mdb_tools functions on synthetic data at several scales (see mdb_tools.synthetic).
+
+Example usage (from the repository root):
+python benchmarks/bench_mdb_tools.py --scales 1m 1y 5y --out bench_results.csv
+
+# Include the load_data getters, against mongomock or a local mongod
+python benchmarks/bench_mdb_tools.py --scales 1m --mongomock
+python benchmarks/bench_mdb_tools.py --scales 1y --mongo-uri mongodb://localhost:27017
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+import pandas as pd
+
+from mdb_tools import loop_stats as oop
+from mdb_tools import synthetic
+
+
+def measure(function, repeats=3):
+    """
+    Run a function a few times and return the best wall time (seconds), then once more under tracemalloc and return
+    the peak memory allocated during the call (bytes)
+    """
+    times = []
+    for _ in range(repeats):
+        t_start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t_start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(times), peak
+
+
+def stats_benchmarks(dataset, time_zone):
+    """
+    The loop_stats functions, as (name, rows processed, function) tuples
+    """
+    df_entries = dataset["entries"]
+    entry_times = pd.Series(pd.to_datetime(df_entries["date"], unit='ms', utc=True)).dt.tz_convert(time_zone)
+    sgv = df_entries["sgv"].to_numpy()
+    df_treatments = dataset["treatments"]
+    df_devicestatus = dataset["devicestatus"]
+    timeline = oop.ProfileTimeline(dataset["profile"])
+    pod_changes = oop.get_pod_changes(df_devicestatus)
+    days = (entry_times.iloc[-1].normalize(), entry_times.iloc[0].normalize())
+    status_chunks = [df_devicestatus.iloc[start:start + 10000] for start in range(0, len(df_devicestatus), 10000)]
+
+    return [
+        ("get_yeardays", len(entry_times), lambda: oop.get_yeardays(entry_times)),
+        ("get_yeardays(as_int)", len(entry_times), lambda: oop.get_yeardays(entry_times, as_int=True)),
+        ("daily_cgm_stats", len(entry_times), lambda: oop.daily_cgm_stats(entry_times, sgv)),
+        ("get_setting_at_times", len(entry_times),
+         lambda: oop.get_setting_at_times(entry_times, timeline, req_setting="basal")),
+        ("daily_insulin_totals", len(df_treatments),
+         lambda: oop.daily_insulin_totals(df_treatments, timeline, days[1], days[0], time_zone=time_zone)),
+        ("get_pod_changes", len(df_devicestatus), lambda: oop.get_pod_changes(df_devicestatus)),
+        ("tag_pod_sessions", len(entry_times), lambda: oop.tag_pod_sessions(entry_times, pod_changes)),
+        ("bg_histogram", len(entry_times), lambda: oop.bg_histogram(entry_times, sgv, time_zone=time_zone)),
+        ("dedupe_entries", len(df_entries), lambda: oop.dedupe_entries(df_entries)),
+        ("daily_devicestatus_summary", len(df_devicestatus),
+         lambda: oop.daily_devicestatus_summary(status_chunks, time_zone=time_zone)),
+    ]
+
+
+def loader_benchmarks(db):
+    """
+    The load_data getters, as (name, rows processed, function) tuples
+    """
+    from mdb_tools import load_data as ld
+
+    collections = (db["entries"], db["treatments"], db["profile"], db["devicestatus"])
+    n_docs = {col.name: col.estimated_document_count() for col in collections}
+
+    return [
+        ("get_entries_df", n_docs["entries"], lambda: ld.get_entries_df(db["entries"])),
+        ("get_treatments_df", n_docs["treatments"], lambda: ld.get_treatments_df(db["treatments"])),
+        ("get_devicestatus_df", n_docs["devicestatus"], lambda: ld.get_devicestatus_df(db["devicestatus"])),
+        ("load_all", sum(n_docs.values()), lambda: ld.load_all(collections=collections)),
+    ]
+
+
+def run(scales, time_zone="US/Eastern", mongomock=False, mongo_uri=None, repeats=3):
+    """
+    Run every benchmark at every scale
+
+    Returns: pandas dataframe with one row per scale and function: seconds, peak memory and rows per second
+
+    """
+    results = []
+    for scale in scales:
+        t_start = time.perf_counter()
+        dataset = synthetic.make_dataset(scale)
+        print("Generated", scale, "dataset in %.1f s" % (time.perf_counter() - t_start))
+
+        benchmarks = stats_benchmarks(dataset, time_zone)
+
+        if mongomock or mongo_uri is not None:
+            if mongo_uri is not None:
+                from pymongo import MongoClient
+                client = MongoClient(mongo_uri)
+            else:
+                import mongomock as mm
+                client = mm.MongoClient()
+            db = client["mdb_tools_bench_" + scale]
+            for name in ["entries", "treatments", "profile", "devicestatus"]:
+                db.drop_collection(name)
+            synthetic.load_dataset(db, dataset)
+            benchmarks += loader_benchmarks(db)
+
+        for name, rows, function in benchmarks:
+            seconds, peak = measure(function, repeats)
+            results.append({"scale": scale, "function": name, "rows": rows, "seconds": seconds,
+                            "peak_mb": peak / 1e6, "rows_per_second": rows / seconds if seconds > 0 else np.inf})
+            print("%-5s %-28s %10d rows %9.4f s %9.1f MB" % (scale, name, rows, seconds, peak / 1e6))
+
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", nargs="+", default=["1m", "1y"], help="scales to run: 1m, 1y, 5y or a number of days")
+    parser.add_argument("--time-zone", default="US/Eastern", help="local time zone for the daily statistics")
+    parser.add_argument("--mongomock", action="store_true", help="also benchmark the loaders against mongomock")
+    parser.add_argument("--mongo-uri", default=None, help="also benchmark the loaders against this database")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per function (the best is kept)")
+    parser.add_argument("--out", default=None, help="write the results to this csv file")
+    args = parser.parse_args()
+
+    df_results = run(args.scales, args.time_zone, args.mongomock, args.mongo_uri, args.repeats)
+    if args.out is not None:
+        df_results.to_csv(args.out, index=False)
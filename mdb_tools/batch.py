@@ -0,0 +1,229 @@
+"""batch.py
+Run the daily reports for many Nightscout databases (one per person) at once.
+
+Each person's data is loaded and summarized (daily CGM statistics and daily insulin totals) in its own worker process,
+with a bounded number of processes running at a time. Finished reports are appended to one Parquet file as they
+arrive (one row per person per day), so memory use does not grow with the number of people. A person whose database
+can't be reached, or whose data can't be summarized, is reported as failed without stopping the others.
+
+Example usage:
+df_status = batch.run_batch(["alice.yml", "bob.yml"], "fleet_report.parquet", start='2023-11-01', end='2023-12-01',
+                            time_zone='US/Eastern', max_workers=8)
+df_report = pd.read_parquet("fleet_report.parquet")
+"""
+import multiprocessing
+import os
+import time
+import traceback
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from mdb_tools import load_data as ld
+from mdb_tools import loop_stats as oop
+
+# Columns of the combined report, one row per person per day
+CGM_COLUMNS = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max', 'pct_above', 'pct_below', 'pct_inrange']
+INSULIN_COLUMNS = ['basal', 'basal_adjust', 'basal_total', 'bolus', 'insulin_sum']
+report_arrow_schema = pa.schema([('person', pa.string()), ('date', pa.timestamp('ns'))] +
+                                [(column, pa.float64()) for column in CGM_COLUMNS + INSULIN_COLUMNS])
+
+
+def _uri_database(uri):
+    """
+    Get the database name in a mongodb URI (or None), without resolving anything: pymongo's parser looks up the DNS
+    records of a mongodb+srv:// URI
+    """
+    db_name = urllib.parse.unquote(urllib.parse.urlsplit(uri).path.lstrip("/"))
+
+    return db_name if len(db_name) > 0 else None
+
+
+def _source_name(source):
+    """
+    Name a person's data source: the file name of a yml secrets file, or the database name of a URI
+    """
+    if isinstance(source, (tuple, list)):
+        return source[1]
+    if os.path.isfile(source):
+        return os.path.splitext(os.path.basename(source))[0]
+
+    return _uri_database(source)
+
+
+def _source_label(source):
+    """
+    Name a data source for the run status, without ever showing a URI (which may hold a password)
+    """
+    try:
+        return _source_name(source) or "unnamed"
+    except Exception:
+        return "unnamed"
+
+
+def _source_collections(source):
+    """
+    Get the entries, treatments, profile and devicestatus collections of a data source: a yml secrets file, a mongodb
+    URI that includes the database name, or a (URI, database name) pair
+    """
+    if isinstance(source, (tuple, list)):
+        uri, db_name = source
+    elif os.path.isfile(source):
+        uri, db_name = ld.read_secrets(source)
+    else:
+        uri, db_name = source, _uri_database(source)
+        if db_name is None:
+            raise Exception("The URI has no database name, pass a (URI, database name) pair instead")
+
+    return tuple(ld.get_collection(name, uri=uri, db_name=db_name)
+                 for name in ["entries", "treatments", "profile", "devicestatus"])
+
+
+def _local_day_bounds(times, time_zone):
+    """
+    First local day and the day after the last one (naive local midnights) spanned by an array of UTC times
+    """
+    local_times = pd.DatetimeIndex(times).tz_convert(time_zone).tz_localize(None)
+
+    return local_times.min().normalize(), local_times.max().normalize() + pd.Timedelta(days=1)
+
+
+def person_report(source, start=None, end=None, time_zone='UTC', min_target=70, max_target=180,
+                  req_profile="Default", dedupe=True, collections=None):
+    """
+    Load one person's data and compute their daily CGM statistics and daily insulin totals
+
+    Args:
+        source (str or tuple): yml secrets file, mongodb URI that includes the database name, or (URI, database name)
+        start (datetime-like, Optional): first day. Time zone naive times are local times in time_zone. Default is
+            the first day with data.
+        end (datetime-like, Optional): end of the period (exclusive). Time zone naive times are local times in
+            time_zone. Default is the day after the last day with data.
+        time_zone (str, Optional): time zone that defines the days, default is "UTC"
+        min_target (num, Optional): minimum blood glucose target in mg/dL, default is 70
+        max_target (num, Optional): maximum blood glucose target in mg/dL, default is 180
+        req_profile (str, Optional): profile name for the scheduled basal. Default is "Default".
+        dedupe (bool, Optional): drop CGM readings uploaded by more than one source (see loop_stats.dedupe_entries()),
+            default is True
+        collections (tuple, Optional): collections as returned by load_data.get_collections(), instead of connecting
+            to source
+
+    Returns: pandas dataframe with one row per day: person, date, the CGM_COLUMNS and the INSULIN_COLUMNS
+
+    """
+    collections = _source_collections(source) if collections is None else collections
+
+    start = None if start is None else pd.Timestamp(start)
+    end = None if end is None else pd.Timestamp(end)
+    start_utc = None if start is None else (start.tz_localize(time_zone) if start.tz is None else start)
+    end_utc = None if end is None else (end.tz_localize(time_zone) if end.tz is None else end)
+
+    # The device statuses (by far the largest collection) aren't needed for the report
+    loop_data = ld.load_all(collections=collections, start=start_utc, end=end_utc, compact=True,
+                            names=("entries", "treatments", "profile"))
+
+    # ##### Daily CGM statistics #####
+    df_entries = loop_data.entries
+    if dedupe and len(df_entries) > 0:
+        df_entries = oop.dedupe_entries(df_entries)
+    df_cgm_daily = oop.daily_cgm_stats(df_entries.index, df_entries["sgv"], min_target, max_target, time_zone)
+    df_cgm_daily = df_cgm_daily.set_index("time")[CGM_COLUMNS]
+
+    # ##### Daily insulin totals #####
+    df_treatments = loop_data.treatments
+    if len(df_treatments) > 0 and len(loop_data.profile) > 0:
+        first_day, last_day = _local_day_bounds(df_treatments.index, time_zone)
+        df_insulin = oop.daily_insulin_totals(df_treatments, oop.ProfileTimeline(loop_data.profile),
+                                              first_day if start is None else start,
+                                              last_day if end is None else end,
+                                              time_zone=time_zone, req_profile=req_profile)
+        df_insulin.index = pd.DatetimeIndex(df_insulin.index)
+    else:
+        df_insulin = pd.DataFrame(columns=INSULIN_COLUMNS, dtype='float64')
+
+    df_daily = df_cgm_daily.join(df_insulin[INSULIN_COLUMNS], how='outer')
+    df_daily.index = pd.DatetimeIndex(df_daily.index).rename("date")
+    df_daily = df_daily.reset_index()
+    df_daily.insert(0, "person", _source_name(source))
+
+    return df_daily
+
+
+def _run_person(source, kwargs):
+    """
+    Worker: run person_report() for one source, returning the report or the error instead of raising
+    """
+    t_start = time.perf_counter()
+    try:
+        df_daily = person_report(source, **kwargs)
+        return _source_name(source), df_daily, None, time.perf_counter() - t_start
+    except Exception:
+        return _source_label(source), None, traceback.format_exc(), time.perf_counter() - t_start
+    finally:
+        ld.close_clients()
+
+
+def _report_table(df_daily):
+    """
+    Convert one person's report to an Arrow table with the fixed report schema
+    """
+    df_daily = df_daily.reindex(columns=report_arrow_schema.names)
+    df_daily["date"] = pd.to_datetime(df_daily["date"])
+    for column in CGM_COLUMNS + INSULIN_COLUMNS:
+        df_daily[column] = df_daily[column].astype('float64')
+
+    return pa.Table.from_pandas(df_daily, schema=report_arrow_schema, preserve_index=False)
+
+
+def run_batch(sources, out_file, max_workers=None, **kwargs):
+    """
+    Run person_report() for every source in a pool of worker processes, appending each finished report to one
+    Parquet file
+
+    Args:
+        sources (list): yml secrets files, mongodb URIs (including the database name) or (URI, database name) pairs,
+            one per person
+        out_file (str): path of the Parquet file to write (replaced if it exists)
+        max_workers (int, Optional): number of worker processes at most. Default is the number of CPUs.
+        **kwargs: passed on to person_report(), e.g. start, end and time_zone
+
+    Returns: pandas dataframe with one row per source: source (position in sources), person, status ("ok" or
+        "failed"), days (rows written), seconds and error (traceback of a failure)
+
+    """
+    max_workers = min(max_workers or os.cpu_count() or 1, max(len(sources), 1))
+
+    # Workers are started fresh (not forked), so that they don't inherit the parent's MongoDB clients
+    context = multiprocessing.get_context("spawn")
+
+    statuses = []
+    with pq.ParquetWriter(out_file, report_arrow_schema) as writer, \
+            ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+        futures = {executor.submit(_run_person, source, kwargs): number for number, source in enumerate(sources)}
+        for future in as_completed(futures):
+            number = futures[future]
+            try:
+                person, df_daily, error, seconds = future.result()
+            except Exception:
+                # The worker process itself died
+                person, df_daily, error, seconds = _source_label(sources[number]), None, traceback.format_exc(), np.nan
+
+            days = 0
+            if df_daily is not None:
+                try:
+                    table = _report_table(df_daily)
+                    writer.write_table(table)
+                    days = table.num_rows
+                except Exception:
+                    error = traceback.format_exc()
+
+            statuses.append({"source": number, "person": person, "status": "ok" if error is None else "failed",
+                             "days": days, "seconds": seconds, "error": error})
+
+    df_status = pd.DataFrame(statuses, columns=["source", "person", "status", "days", "seconds", "error"])
+
+    return df_status.sort_values("source").reset_index(drop=True)
@@ -0,0 +1,219 @@
+"""instrument.py
+Opt-in timing instrumentation for the mdb_tools loaders and statistics.
+
+When enabled, every instrumented function (and any span() block) records its wall time, the number of rows and bytes
+it returned, and optionally its peak memory, so that a slow report can be broken down into the Mongo fetch, the
+Arrow-to-pandas conversion and the statistics. When disabled (the default), an instrumented function costs one extra
+flag check per call.
+
+Spans are nested per thread, so the loads that load_all() runs on worker threads appear as top-level spans of those
+threads. Peak memory is measured with tracemalloc, which is process-wide, so it is only exact for single-threaded code.
+
+Example usage:
+instrument.enable(track_memory=True)
+loop_data = ld.load_all(yml_secrets_file)
+df_cgm_daily = oop.daily_cgm_stats(df_entries["time"], df_entries["sgv"])
+print(instrument.report())
+instrument.disable()
+"""
+import functools
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Whether spans are being recorded, and whether their peak memory is tracked too
+_enabled = False
+_track_memory = False
+
+# Finished spans (dicts), and the open spans of each thread (so that nested spans know their parent)
+_records = []
+_records_lock = threading.Lock()
+_local = threading.local()
+
+
+def enable(track_memory=False):
+    """
+    Start recording spans
+
+    Args:
+        track_memory (bool, Optional): also record the peak memory of each span with tracemalloc. This slows the
+            instrumented code down noticeably. Default is False.
+
+    """
+    global _enabled, _track_memory
+    _enabled = True
+    _track_memory = track_memory
+    if track_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """
+    Stop recording spans (the spans recorded so far are kept until reset())
+    """
+    global _enabled, _track_memory
+    _enabled = False
+    if _track_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _track_memory = False
+
+
+def is_enabled():
+    """
+    Returns: (bool) whether spans are being recorded
+    """
+    return _enabled
+
+
+def reset():
+    """
+    Forget every recorded span
+    """
+    with _records_lock:
+        _records.clear()
+
+
+def _result_size(result):
+    """
+    Number of rows and bytes of a result (dataframe, Arrow table, array or list), where they can be found cheaply
+    """
+    rows = len(result) if hasattr(result, "__len__") and not isinstance(result, (str, dict, tuple)) else None
+
+    if hasattr(result, "nbytes") and not callable(result.nbytes):
+        n_bytes = int(result.nbytes)
+    elif hasattr(result, "memory_usage") and hasattr(result, "columns"):
+        n_bytes = int(result.memory_usage(deep=False).sum())
+    else:
+        n_bytes = None
+
+    return rows, n_bytes
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Record the wall time (and peak memory) of a block of code. Set "rows" or "bytes" on the yielded record to record
+    the amount of data the block processed.
+
+    Example usage:
+    with instrument.span("to_datetime") as record:
+        df_entries["time"] = pd.to_datetime(df_entries["dateString"])
+        record["rows"] = len(df_entries)
+
+    Args:
+        name (str): name of the span
+        **attributes: any other values to keep with the span
+
+    Yields: (dict) the span's record
+
+    """
+    if not _enabled:
+        yield {}
+        return
+
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+
+    record = {"name": name, "parent": stack[-1]["name"] if stack else None, "depth": len(stack),
+              "thread": threading.current_thread().name, "start": time.time(), "seconds": None, "rows": None,
+              "bytes": None, "peak_bytes": None}
+    record.update(attributes)
+
+    memory_start = 0
+    if _track_memory and tracemalloc.is_tracing():
+        memory_start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        record["_child_peak"] = 0
+
+    stack.append(record)
+    t_start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = time.perf_counter() - t_start
+        stack.pop()
+
+        if "_child_peak" in record:
+            # The peak since the last reset (children reset it too), or the highest child peak if that was higher
+            peak = max(tracemalloc.get_traced_memory()[1], record.pop("_child_peak"))
+            record["peak_bytes"] = peak - memory_start
+            if stack and "_child_peak" in stack[-1]:
+                stack[-1]["_child_peak"] = max(stack[-1]["_child_peak"], peak)
+
+        with _records_lock:
+            _records.append(record)
+
+
+def timed(function):
+    """
+    Decorator that records a span for every call of a function, named after the function, with the rows and bytes
+    of what it returns
+    """
+    name = function.__module__.split(".")[-1] + "." + function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+        with span(name) as record:
+            result = function(*args, **kwargs)
+            record["rows"], record["bytes"] = _result_size(result)
+        return result
+
+    return wrapper
+
+
+def report():
+    """
+    The recorded spans, in the order they finished
+
+    Returns: pandas dataframe with name, parent, depth, thread, start (epoch seconds), seconds, rows, bytes and
+        peak_bytes columns (plus any extra span attributes)
+
+    """
+    import pandas as pd
+
+    with _records_lock:
+        records = list(_records)
+
+    return pd.DataFrame(records, columns=None if records else ["name", "parent", "depth", "thread", "start",
+                                                                "seconds", "rows", "bytes", "peak_bytes"])
+
+
+def summary():
+    """
+    Total time, calls, rows and bytes per span name, slowest first
+
+    Returns: pandas dataframe indexed by span name
+
+    """
+    df_report = report()
+
+    return (df_report.groupby("name")
+            .agg(calls=("seconds", "size"), seconds=("seconds", "sum"), rows=("rows", "sum"),
+                 bytes=("bytes", "sum"), peak_bytes=("peak_bytes", "max"))
+            .sort_values("seconds", ascending=False))
+
+
+def to_json(path=None):
+    """
+    The recorded spans as json
+
+    Args:
+        path (str, Optional): write the json to this file as well
+
+    Returns: (str) json list of span records
+
+    """
+    with _records_lock:
+        records = list(_records)
+    text = json.dumps(records, default=str)
+
+    if path is not None:
+        with open(path, "w") as file:
+            file.write(text)
+
+    return text
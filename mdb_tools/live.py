@@ -0,0 +1,235 @@
+"""live.py
+Keep daily CGM statistics up to date as new entries arrive, without reloading the entries collection.
+
+New readings are folded into per-day running totals (counts, sums, sums of squares, minimum, maximum and
+above/below/in-range counts), so each update only costs as much as the number of new readings.
+
+Example usage:
+accumulator = live.DailyCGMAccumulator(time_zone='US/Eastern')
+for accumulator in live.follow_entries(col_entries, accumulator, poll_interval=60):
+    df_cgm_daily = accumulator.daily_stats()
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from mdb_tools import load_data as ld
+from mdb_tools import loop_stats as oop
+
+# Running totals kept for each day, in this order
+_TOTALS = ["n", "count", "sum", "sum_sq", "min", "max", "above", "below", "inrange"]
+_SUMMED = [_TOTALS.index(total) for total in ["n", "count", "sum", "sum_sq", "above", "below", "inrange"]]
+_MIN = _TOTALS.index("min")
+_MAX = _TOTALS.index("max")
+
+
+def _fold_totals(all_totals, key, new_totals):
+    """
+    Fold one day's (or week's) new totals into a dict of running totals
+    """
+    totals = all_totals.get(key)
+    if totals is None:
+        all_totals[key] = new_totals.copy()
+        return
+    totals[_SUMMED] += new_totals[_SUMMED]
+    totals[_MIN] = np.fmin(totals[_MIN], new_totals[_MIN])
+    totals[_MAX] = np.fmax(totals[_MAX], new_totals[_MAX])
+
+
+def _stats_from_totals(all_totals):
+    """
+    Build a daily_cgm_stats() style dataframe (without quartiles) from running totals keyed by integer day
+    """
+    day_keys = np.array(sorted(all_totals.keys()), dtype='int64')
+    totals = np.array([all_totals[day_key] for day_key in day_keys], dtype='float64').reshape(-1, len(_TOTALS))
+    df_totals = pd.DataFrame(totals, columns=_TOTALS)
+
+    mean = df_totals["sum"] / df_totals["count"]
+    variance = (df_totals["sum_sq"] - df_totals["count"] * mean ** 2) / (df_totals["count"] - 1)
+
+    day_times = oop.yearday_keys_to_dates(day_keys)
+    df_stats = pd.DataFrame({
+        "count": df_totals["count"].values,
+        "mean": mean.values,
+        "std": np.sqrt(variance.clip(lower=0)).values,
+        "min": df_totals["min"].values,
+        "max": df_totals["max"].values,
+        "yearday": day_times.strftime('%Y-%j'),
+        "time": day_times,
+        "pct_above": (df_totals["above"] / df_totals["n"] * 100).values,
+        "pct_below": (df_totals["below"] / df_totals["n"] * 100).values,
+        "pct_inrange": (df_totals["inrange"] / df_totals["n"] * 100).values,
+    }, index=pd.Index(day_times.strftime('%Y-%j'), name="yearday"))
+
+    return df_stats
+
+
+class DailyCGMAccumulator:
+    """
+    Per-day running totals of CGM readings, which can produce a daily_cgm_stats() style dataframe at any moment.
+
+    Args:
+        min_target (num, Optional): minimum blood glucose target in mg/dL, default is 70
+        max_target (num, Optional): maximum blood glucose target in mg/dL, default is 180
+        time_zone (str, Optional): time zone that defines the day boundaries. Default (None) uses the time zone of
+            the times passed to update() as they are.
+
+    """
+
+    def __init__(self, min_target=70, max_target=180, time_zone=None):
+        self.min_target = min_target
+        self.max_target = max_target
+        self.time_zone = time_zone
+
+        # Running totals, keyed by integer day (see loop_stats.get_yeardays())
+        self.totals = {}
+
+        # Newest reading time folded in so far
+        self.watermark = None
+
+    def update(self, time_vec, cgm_data):
+        """
+        Fold new readings into the running totals
+
+        Args:
+            time_vec (array-like): array or list or series of times
+            cgm_data (array-like): array or list or series of CGM values at each point in time_vec
+
+        Returns: (int) number of readings folded in
+
+        """
+        times = pd.DatetimeIndex(time_vec)
+        if len(times) == 0:
+            return 0
+
+        day_keys = oop.get_yeardays(times, as_int=True, time_zone=self.time_zone).values
+        bg = np.asarray(cgm_data, dtype='float64')
+        valid = ~np.isnan(bg)
+
+        # Totals for just the new readings, one row per day they touch
+        df_new = pd.DataFrame({
+            "n": 1,
+            "count": valid.astype('int64'),
+            "sum": np.where(valid, bg, 0),
+            "sum_sq": np.where(valid, bg ** 2, 0),
+            "min": bg,
+            "max": bg,
+            "above": bg > self.max_target,
+            "below": bg <= self.min_target,
+            "inrange": (bg > self.min_target) & (bg <= self.max_target),
+        }).groupby(day_keys).agg({"n": "sum", "count": "sum", "sum": "sum", "sum_sq": "sum", "min": "min",
+                                  "max": "max", "above": "sum", "below": "sum", "inrange": "sum"})
+
+        for day_key, new_totals in zip(df_new.index, df_new[_TOTALS].to_numpy(dtype='float64')):
+            _fold_totals(self.totals, day_key, new_totals)
+
+        newest = times.max()
+        if self.watermark is None or newest > self.watermark:
+            self.watermark = newest
+
+        return len(times)
+
+    def daily_stats(self):
+        """
+        Daily statistics from the running totals
+
+        Returns: pandas dataframe with the daily_cgm_stats() columns, except for the quartiles (count, mean, std, min,
+            max, yearday, time, pct_above, pct_below and pct_inrange), indexed by yearday
+
+        """
+        return _stats_from_totals(self.totals)
+
+    def weekly_stats(self):
+        """
+        Weekly (Monday to Sunday) statistics from the running totals
+
+        Returns: pandas dataframe with the same columns as daily_stats(), one row per week, where yearday and time are
+            those of the week's Monday
+
+        """
+        week_totals = {}
+        for day_key, totals in self.totals.items():
+            # Day 0 (1970-01-01) was a Thursday
+            _fold_totals(week_totals, day_key - (day_key + 3) % 7, totals)
+
+        return _stats_from_totals(week_totals)
+
+
+def _entries_since(col_entries, watermark_ms):
+    """
+    Get the entries newer than a watermark (milliseconds) as a dataframe with "time" and "sgv" columns
+    """
+    query = {} if watermark_ms is None else {"date": {"$gt": watermark_ms}}
+    schema = ld.project_schema(ld.get_schema("entries"), ["sgv", "date"])
+    df_new = ld.find_arrow_table(col_entries, query, schema).to_pandas()
+    df_new["time"] = pd.to_datetime(df_new["date"], unit='ms', utc=True)
+
+    return df_new
+
+
+def follow_entries(col_entries, accumulator=None, poll_interval=60, since=None, use_change_stream=False,
+                   max_updates=None):
+    """
+    Tail the entries collection and fold each new reading into a DailyCGMAccumulator, yielding the accumulator after
+    every update.
+
+    By default the collection is polled for entries with a "date" newer than the newest one seen so far. With
+    use_change_stream=True, inserts are read from a change stream instead (this needs a replica set). Either way, a
+    reading is only folded in once, and readings no newer than the newest one already seen are skipped.
+
+    Args:
+        col_entries: A MongoDB collection containing information from the CGM (continuous glucose monitor).
+        accumulator (DailyCGMAccumulator, Optional): accumulator to update, default is a new one
+        poll_interval (num, Optional): seconds between polls, default is 60
+        since (datetime-like, Optional): only fold in entries after this time. Default is the accumulator's
+            watermark, or the whole collection for a new accumulator.
+        use_change_stream (bool, Optional): read inserts from a change stream instead of polling, default is False
+        max_updates (int, Optional): stop after this many updates. Default (None) follows forever.
+
+    Yields: DailyCGMAccumulator
+
+    """
+    accumulator = DailyCGMAccumulator() if accumulator is None else accumulator
+    since = accumulator.watermark if since is None else since
+    watermark_ms = None
+    if since is not None:
+        since = pd.Timestamp(since)
+        watermark_ms = (since.tz_localize('UTC') if since.tz is None else since).value // 1_000_000
+
+    n_updates = 0
+    if use_change_stream:
+        # Catch up on anything since the watermark, then follow the inserts. The stream is opened first so that
+        # nothing is missed in between, which means a reading inserted during the catch-up can come back from both:
+        # stream documents at or before the newest reading already folded in are dropped.
+        with col_entries.watch([{"$match": {"operationType": "insert"}}]) as stream:
+            df_new = _entries_since(col_entries, watermark_ms)
+            while True:
+                if len(df_new) > 0:
+                    accumulator.update(df_new["time"], df_new["sgv"])
+                    watermark_ms = int(df_new["date"].max())
+                    n_updates += 1
+                    yield accumulator
+                if max_updates is not None and n_updates >= max_updates:
+                    break
+                docs = [stream.next()["fullDocument"]]
+                while True:
+                    change = stream.try_next()
+                    if change is None:
+                        break
+                    docs.append(change["fullDocument"])
+                docs = [doc for doc in docs if watermark_ms is None or doc["date"] > watermark_ms]
+                df_new = pd.DataFrame({"sgv": [doc.get("sgv") for doc in docs],
+                                       "date": [doc["date"] for doc in docs]})
+                df_new["time"] = pd.to_datetime(df_new["date"], unit='ms', utc=True)
+        return
+
+    while max_updates is None or n_updates < max_updates:
+        df_new = _entries_since(col_entries, watermark_ms)
+        if len(df_new) > 0:
+            accumulator.update(df_new["time"], df_new["sgv"])
+            watermark_ms = int(df_new["date"].max())
+            n_updates += 1
+            yield accumulator
+        else:
+            time.sleep(poll_interval)
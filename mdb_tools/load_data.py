@@ -1,33 +1,75 @@
 """load_data.py
 Import Loop data from a mongodB/Atlas database.
 """
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
-import yaml
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import os
+import threading
+import time
+import pandas as pd
+import pyarrow as pa
 
-# Pyarrow - importing mongo databases into pandas
-import pymongoarrow.monkey
-from mdb_tools.schemas import mdb_schemas
-# import pyarrow as pa
-# from pymongoarrow.api import Schema
+from mdb_tools import instrument
 
-# Add extra find_* methods to pymongo collection objects (pymongoarrow):
-pymongoarrow.monkey.patch_all()
+# pymongo, pymongoarrow, yaml and the schemas are imported by the functions that use them, so importing this module
+# (e.g. just for TIME_FIELDS, or through live or mirror) doesn't pay for them
 
+# Field in each collection that orders its documents in time
+TIME_FIELDS = {
+    "entries": "date",
+    "treatments": "created_at",
+    "devicestatus": "created_at",
+    "profile": "mills",
+}
 
-def get_collections(yml_secrets_file):
+
+# Process-wide clients, keyed by URI, so that repeated calls reuse warm connection pools
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Whether pymongoarrow's extra find_* methods have been added to pymongo collection objects yet
+_patched = False
+
+
+def _patch_pymongo():
     """
-    Using the URI for the mongodb database, load a set of collections (the selection is currently hard-coded
+    Add pymongoarrow's extra find_* methods (find_pandas_all, find_arrow_all, ...) to pymongo collection objects, the
+    first time a client is made
+    """
+    global _patched
+    if not _patched:
+        import pymongoarrow.monkey
+        pymongoarrow.monkey.patch_all()
+        _patched = True
 
-    Example usage:
-    col_entries, col_treatments, col_profile, col_device_status = ld.get_collections(yml_secrets_file)
+
+# Secrets already read, keyed by yml file path (and re-read if the file changes)
+_secrets_cache = {}
+
+
+def read_secrets(yml_secrets_file):
+    """
+    Read the mongodb URI and database name from a yml secrets file. The file is only read again if it changes.
+
+    The yml file only requires the following:
+
+    secrets:
+      mongo_uri: <mongo-uri-here>
+      mongo_db: <db-name>
 
     Args:
         yml_secrets_file (str): path to a yml file containing the URI and mongodB name.
 
-    Returns: A tuple containing a specific set of collections (basically, tables, from the mongo database: entries, treatments, profile, and device status, in that order.
+    Returns: (tuple) URI and database name
 
     """
+    modified = os.path.getmtime(yml_secrets_file)
+    cached = _secrets_cache.get(yml_secrets_file)
+    if cached is not None and cached[0] == modified:
+        return cached[1]
+
+    import yaml
 
     # Load the yml file and read the URI and database name
     with open(yml_secrets_file) as file:
@@ -38,8 +80,101 @@ def get_collections(yml_secrets_file):
     uri = mdb_secrets['secrets']['mongo_uri']
     db_name = mdb_secrets['secrets']['mongo_db']
 
-    # Create a new client and connect to the server
-    client = MongoClient(uri, server_api=ServerApi('1'))
+    _secrets_cache[yml_secrets_file] = (modified, (uri, db_name))
+
+    return uri, db_name
+
+
+def get_client(uri, max_pool_size=100, min_pool_size=0, timeout_ms=20000):
+    """
+    Get the shared client for a URI, creating it the first time the URI is seen. The client connects lazily (on the
+    first operation), and is reused by every later call with the same URI, whatever options those calls pass.
+
+    Args:
+        uri (str): mongodb URI
+        max_pool_size (int, Optional): maximum number of connections in the pool, default is 100
+        min_pool_size (int, Optional): number of connections to keep open, default is 0
+        timeout_ms (int, Optional): server selection and connection timeout in milliseconds, default is 20000
+
+    Returns: pymongo MongoClient
+
+    """
+    from pymongo.mongo_client import MongoClient
+    from pymongo.server_api import ServerApi
+
+    with _clients_lock:
+        _patch_pymongo()
+        client = _clients.get(uri)
+        if client is None:
+            client = MongoClient(uri, server_api=ServerApi('1'), connect=False,
+                                 maxPoolSize=max_pool_size, minPoolSize=min_pool_size,
+                                 serverSelectionTimeoutMS=timeout_ms, connectTimeoutMS=timeout_ms)
+            _clients[uri] = client
+
+    return client
+
+
+def close_clients(uri=None):
+    """
+    Close shared clients and remove them from the registry (the next get_client() call makes a new one), along with
+    their memoized profile timelines (see loop_stats.get_profile_timeline())
+
+    Args:
+        uri (str, Optional): only close the client for this URI. Default (None) closes every client.
+
+    """
+    from mdb_tools.loop_stats import clear_profile_timelines
+
+    with _clients_lock:
+        uris = list(_clients.keys()) if uri is None else [uri]
+        for this_uri in uris:
+            client = _clients.pop(this_uri, None)
+            if client is not None:
+                clear_profile_timelines(client)
+                client.close()
+
+
+def get_collection(name, yml_secrets_file=None, uri=None, db_name=None):
+    """
+    Get one collection by name, through the shared client
+
+    Example usage:
+    col_entries = ld.get_collection("entries", yml_secrets_file)
+
+    Args:
+        name (str): collection name, e.g. "entries"
+        yml_secrets_file (str, Optional): path to a yml file containing the URI and mongodB name
+        uri (str, Optional): mongodb URI, instead of yml_secrets_file
+        db_name (str, Optional): database name, instead of yml_secrets_file
+
+    Returns: pymongo Collection
+
+    """
+    if yml_secrets_file is not None:
+        uri, db_name = read_secrets(yml_secrets_file)
+
+    return get_client(uri)[db_name][name]
+
+
+def get_collections(yml_secrets_file):
+    """
+    Using the URI for the mongodb database, load a set of collections (the selection is currently hard-coded
+
+    The client is shared (see get_client()), so calling this again reuses the existing connections.
+
+    Example usage:
+    col_entries, col_treatments, col_profile, col_device_status = ld.get_collections(yml_secrets_file)
+
+    Args:
+        yml_secrets_file (str): path to a yml file containing the URI and mongodB name.
+
+    Returns: A tuple containing a specific set of collections (basically, tables, from the mongo database: entries, treatments, profile, and device status, in that order.
+
+    """
+    uri, db_name = read_secrets(yml_secrets_file)
+
+    # Get the shared client for this URI
+    client = get_client(uri)
 
     # Load the database
     db = client[db_name]
@@ -59,46 +194,446 @@ def get_collections(yml_secrets_file):
     return col_entries, col_treatments, col_profile, col_devicestatus
 
 
-def get_entries_df(col_entries0):
+def get_schema(collection_name, compact=False):
+    """
+    Get the pymongoarrow schema for one of the collections
+
+    Args:
+        collection_name (str): "entries", "treatments" or "devicestatus"
+        compact (bool, Optional): get the compact variant, see schemas.mdb_schemas(). Default is False.
+
+    Returns: pymongoarrow Schema
+
+    """
+    from mdb_tools.schemas import mdb_schemas
+
+    entries_schema, treatments_schema, devicestatus_schema = mdb_schemas(compact)
+    schemas_by_name = {
+        "entries": entries_schema,
+        "treatments": treatments_schema,
+        "devicestatus": devicestatus_schema,
+    }
+    if collection_name not in schemas_by_name:
+        raise Exception(
+            "There is no schema for " + collection_name + ", must be one of: " + ', '.join(schemas_by_name.keys()))
+
+    return schemas_by_name[collection_name]
+
+
+def project_schema(schema, columns=None):
+    """
+    Prune a pymongoarrow schema down to a subset of its columns, so that only those fields are transferred and decoded
+
+    Args:
+        schema: pymongoarrow Schema
+        columns (list, Optional): names of the columns to keep. Default (None) keeps every column.
+
+    Returns: pymongoarrow Schema
+
+    """
+    if columns is None:
+        return schema
+
+    missing = [column for column in columns if column not in schema.typemap]
+    if len(missing) > 0:
+        raise Exception("These columns are not in the schema: " + ', '.join(missing) +
+                        ". Must be some of: " + ', '.join(schema.typemap.keys()))
+
+    from pymongoarrow.api import Schema
+
+    return Schema({column: schema.typemap[column] for column in columns})
+
+
+def time_query(collection_name, start=None, end=None):
+    """
+    Build a query that selects the documents of a collection between two times, using the collection's time field
+    (see TIME_FIELDS) so that the query can be answered from an index on that field.
+
+    Numeric time fields ("date", "mills") are compared in milliseconds since the epoch. ISO time strings
+    ("created_at") are compared as text against the UTC time truncated to the second, without the trailing "Z", which
+    sorts before every time string within that second.
+
+    Args:
+        collection_name (str): "entries", "treatments", "devicestatus" or "profile"
+        start (datetime-like, Optional): keep documents at or after this time. Time zone naive times are taken as UTC.
+        end (datetime-like, Optional): keep documents before this time. Time zone naive times are taken as UTC.
+
+    Returns: (dict) MongoDB query
+
+    """
+    field = TIME_FIELDS[collection_name]
+
+    bounds = {}
+    for operator, bound in [("$gte", start), ("$lt", end)]:
+        if bound is not None:
+            bounds[operator] = _time_bound(field, bound)
+
+    return {field: bounds} if len(bounds) > 0 else {}
+
+
+def _time_bound(field, bound):
+    """
+    Convert a time into the representation of a collection's time field, see time_query()
+    """
+    bound = pd.Timestamp(bound)
+    bound = bound.tz_localize('UTC') if bound.tz is None else bound.tz_convert('UTC')
+    if field == "created_at":
+        return bound.strftime('%Y-%m-%dT%H:%M:%S')
+
+    return bound.value // 1_000_000
+
+
+def ensure_indexes(collections):
+    """
+    Create (if they don't already exist) descending indexes on the time field of each collection, which the time
+    range queries and "latest document" lookups rely on.
+
+    Args:
+        collections (list): MongoDB collections, e.g. the tuple returned by get_collections()
+
+    Returns: (list) names of the indexes
+
+    """
+    from pymongo import DESCENDING
+
+    return [col.create_index([(TIME_FIELDS[col.name], DESCENDING)]) for col in collections]
+
+
+@instrument.timed
+def find_arrow_table(col, query, schema, **kwargs):
+    """
+    Run a query on a collection and return the matching documents as an Arrow table
+
+    Uses pymongoarrow when the collection supports raw BSON batches (pymongo). Otherwise (e.g. a mongomock
+    collection standing in for a real database) the documents are converted to Arrow one by one.
+
+    Args:
+        col: A MongoDB collection
+        query (dict): MongoDB query
+        schema: pymongoarrow Schema of the fields to extract
+        **kwargs: passed on to find(), e.g. sort or limit
+
+    Returns: pyarrow Table
+
+    """
+    from pymongoarrow.api import find_arrow_all
+
+    try:
+        return find_arrow_all(col, query, schema=schema, **kwargs)
+    except NotImplementedError:
+        projection = {field: 1 for field in schema.to_arrow().names}
+        return pa.Table.from_pylist(list(col.find(query, projection, **kwargs)), schema=schema.to_arrow())
+
+
+def iter_arrow_batches(col, query, schema, batch_size=10000):
+    """
+    Run a query on a collection and yield the matching documents as a series of Arrow tables of at most batch_size
+    rows each, decoding one cursor batch at a time so that memory use stays proportional to batch_size.
+
+    Args:
+        col: A MongoDB collection (or a mongomock stand-in)
+        query (dict): MongoDB query
+        schema: pymongoarrow Schema of the fields to extract
+        batch_size (int, Optional): number of documents per batch, default is 10000
+
+    Yields: pyarrow Table
+
+    """
+    from pymongoarrow.context import PyMongoArrowContext
+
+    projection = {field: 1 for field in schema.to_arrow().names}
+
+    try:
+        raw_batches = col.find_raw_batches(query, projection=projection, batch_size=batch_size)
+    except NotImplementedError:
+        # No raw BSON batches (e.g. mongomock): convert the documents one batch at a time
+        cursor = col.find(query, projection)
+        while True:
+            docs = list(itertools.islice(cursor, batch_size))
+            if len(docs) == 0:
+                return
+            yield pa.Table.from_pylist(docs, schema=schema.to_arrow())
+
+    for raw_batch in raw_batches:
+        context = PyMongoArrowContext(schema, codec_options=col.codec_options)
+        context.process_bson_stream(raw_batch)
+        yield context.finish()
+
+
+def iter_batches(col, collection_name, batch_size=10000, start=None, end=None, columns=None, as_pandas=False,
+                 flatten=False):
+    """
+    Yield the documents of a collection between two times in batches, see iter_arrow_batches()
+
+    Args:
+        col: A MongoDB collection
+        collection_name (str): "entries", "treatments" or "devicestatus"
+        batch_size (int, Optional): number of documents per batch, default is 10000
+        start (datetime-like, Optional): only load documents at or after this time (naive times are UTC)
+        end (datetime-like, Optional): only load documents before this time (naive times are UTC)
+        columns (list, Optional): only load these columns of the collection's schema, default is all of them
+        as_pandas (bool, Optional): yield Pandas dataframes instead of Arrow tables, default is False
+        flatten (bool, Optional): flatten nested fields into "parent.child" columns, default is False
+
+    Yields: pyarrow Table or Pandas dataframe
+
+    """
+    query = time_query(collection_name, start, end)
+    schema = project_schema(get_schema(collection_name), columns)
+
+    for table in iter_arrow_batches(col, query, schema, batch_size):
+        if flatten:
+            while any(pa.types.is_struct(field.type) for field in table.schema):
+                table = table.flatten()
+        yield table.to_pandas() if as_pandas else table
+
+
+def iter_devicestatus_batches(col_devicestatus0, batch_size=10000, start=None, end=None, columns=None,
+                              as_pandas=True, flatten=True):
+    """
+    Stream the devicestatus collection in batches instead of loading it all at once (see get_devicestatus_df()).
+    Peak memory is proportional to batch_size rather than to the size of the collection.
+
+    Example usage:
+    df_daily = oop.daily_devicestatus_summary(ld.iter_devicestatus_batches(col_devicestatus), time_zone='US/Eastern')
+
+    Args:
+        col_devicestatus0: A MongoDB collection containing status information from the pump.
+        batch_size (int, Optional): number of documents per batch, default is 10000
+        start (datetime-like, Optional): only load device statuses at or after this time (naive times are UTC)
+        end (datetime-like, Optional): only load device statuses before this time (naive times are UTC)
+        columns (list, Optional): only load these columns of the devicestatus schema, default is all of them
+        as_pandas (bool, Optional): yield Pandas dataframes instead of Arrow tables, default is True
+        flatten (bool, Optional): flatten nested fields into "parent.child" columns (e.g. "loop.iob.iob"),
+            default is True
+
+    Yields: Pandas dataframe (or pyarrow Table) of at most batch_size device statuses
+
+    """
+    return iter_batches(col_devicestatus0, "devicestatus", batch_size, start, end, columns, as_pandas, flatten)
+
+
+def _since_query(field, since=None):
+    """
+    Build a query for documents newer than a watermark: a raw value of the time field (ms for numeric fields, ISO
+    text for "created_at") or a datetime-like
+    """
+    if since is None:
+        return {}
+    is_raw = isinstance(since, (int, float)) or (isinstance(since, str) and field == "created_at")
+
+    return {field: {"$gt": since if is_raw else _time_bound(field, since)}}
+
+
+def get_latest_docs(col, n=1, since=None, time_field=None, projection=None):
+    """
+    Get the newest documents in a collection, newest first. This is a sort on the (indexed, see ensure_indexes())
+    time field with a limit, so the server only touches n documents however big the collection is.
+
+    Example usage:
+    latest_entry = ld.get_latest_docs(col_entries)[0]
+    new_entries = ld.get_latest_docs(col_entries, n=100, since=watermark)
+
+    Args:
+        col: A MongoDB collection
+        n (int, Optional): number of documents, default is 1
+        since (Optional): only return documents newer than this watermark, either a raw value of the time field or
+            a datetime-like (naive times are UTC)
+        time_field (str, Optional): field to sort on. Default is the collection's field from TIME_FIELDS.
+        projection (dict, Optional): fields to return, default is all of them
+
+    Returns: (list) up to n documents
+
+    """
+    from pymongo import DESCENDING
+
+    field = time_field if time_field is not None else TIME_FIELDS.get(col.name, "_id")
+
+    query = _since_query(field, since)
+
+    return list(col.find(query, projection, sort=[(field, DESCENDING)], limit=n))
+
+
+@instrument.timed
+def get_latest_df(col, collection_name=None, n=1, since=None, columns=None):
+    """
+    Get the newest documents in a collection as a Pandas dataframe, newest first, see get_latest_docs()
+
+    Args:
+        col: A MongoDB collection
+        collection_name (str, Optional): "entries", "treatments" or "devicestatus". Default is the collection's name.
+        n (int, Optional): number of documents, default is 1
+        since (Optional): only return documents newer than this watermark (raw value or datetime-like)
+        columns (list, Optional): only load these columns of the collection's schema, default is all of them
+
+    Returns: a Pandas dataframe with up to n rows
+
+    """
+    from pymongo import DESCENDING
+
+    collection_name = col.name if collection_name is None else collection_name
+    field = TIME_FIELDS[collection_name]
+
+    query = _since_query(field, since)
+    schema = project_schema(get_schema(collection_name), columns)
+
+    return find_arrow_table(col, query, schema, sort=[(field, DESCENDING)], limit=n).to_pandas()
+
+
+def _find_df(col, collection_name, start=None, end=None, columns=None, ensure_index=False, compact=False):
+    """
+    Load the documents of a collection between two times into a Pandas dataframe, see get_entries_df()
+    """
+    if ensure_index:
+        ensure_indexes([col])
+
+    query = time_query(collection_name, start, end)
+    if compact and columns is not None and TIME_FIELDS[collection_name] not in columns:
+        # The time index is decoded from the time field
+        columns = list(columns) + [TIME_FIELDS[collection_name]]
+    schema = project_schema(get_schema(collection_name, compact), columns)
+
+    table = find_arrow_table(col, query, schema)
+    if compact:
+        from mdb_tools.schemas import compact_table
+        table = compact_table(table, collection_name)
+    with instrument.span("load_data.to_pandas", collection=collection_name) as record:
+        df = table.to_pandas()
+        record["rows"], record["bytes"] = table.num_rows, table.nbytes
+    if compact:
+        df = df.set_index("time")
+
+    return df
+
+
+@instrument.timed
+def get_entries_df(col_entries0, start=None, end=None, columns=None, ensure_index=False, compact=False):
     """
     Using pyarrow, extract all of the documents in the entries collection and construct a Pandas dataframe from a subset of them.
 
+    Example usage:
+    df_entries = get_entries_df(col_entries, start='2023-11-03', end='2023-11-10', columns=['sgv', 'date'])
+
     Args:
         col_entries0: A MongoDB collection containing information from the CGM (continuous glucose monitor).
+        start (datetime-like, Optional): only load entries at or after this time (naive times are UTC)
+        end (datetime-like, Optional): only load entries before this time (naive times are UTC)
+        columns (list, Optional): only load these columns of the entries schema, default is all of them
+        ensure_index (bool, Optional): create the index on the time field if it doesn't exist, default is False
+        compact (bool, Optional): load with the compact schema (see schemas.compact_table()): the times are decoded
+            at load time, sgv is float32 and device is categorical. Default is False.
 
-    Returns: a Pandas dataframe containing information from the entries collection
+    Returns: a Pandas dataframe containing information from the entries collection. With compact=True, it is indexed
+        by the (UTC) time of each reading.
 
     """
-    _, entries_schema, _, _ = mdb_schemas()
-
-    return col_entries0.find_pandas_all({}, schema=entries_schema)
+    return _find_df(col_entries0, "entries", start, end, columns, ensure_index, compact)
 
 
-def get_treatments_df(col_treatments0):
+@instrument.timed
+def get_treatments_df(col_treatments0, start=None, end=None, columns=None, ensure_index=False, compact=False):
     """
     Using pyarrow, extract all of the documents in the treatments collection and construct a Pandas dataframe from a subset of them.
 
     Args:
         col_treatments0: A MongoDB collection containing treatment information from the pump (boluses, temp basals, corrections, etc)
+        start (datetime-like, Optional): only load treatments at or after this time (naive times are UTC)
+        end (datetime-like, Optional): only load treatments before this time (naive times are UTC)
+        columns (list, Optional): only load these columns of the treatments schema, default is all of them
+        ensure_index (bool, Optional): create the index on the time field if it doesn't exist, default is False
+        compact (bool, Optional): load with the compact schema (see schemas.compact_table()): the time strings are
+            decoded at load time and eventType is categorical. Default is False.
 
-    Returns: a Pandas dataframe containing information from the treatments collection
+    Returns: a Pandas dataframe containing information from the treatments collection. With compact=True, it is
+        indexed by the (UTC) time of each treatment.
 
     """
-    treatment_schema, _, _, _ = mdb_schemas()
-
-    return col_treatments0.find_pandas_all({}, schema=treatment_schema)
+    return _find_df(col_treatments0, "treatments", start, end, columns, ensure_index, compact)
 
 
-def get_devicestatus_df(col_devicestatus0):
+@instrument.timed
+def get_devicestatus_df(col_devicestatus0, start=None, end=None, columns=None, ensure_index=False, compact=False):
     """
     Using pyarrow, extract all of the documents in the devicestatus collection and construct a Pandas dataframe from a subset of them.
 
     Args:
         col_devicestatus0: A MongoDB collection containing status information from the pump.
+        start (datetime-like, Optional): only load device statuses at or after this time (naive times are UTC)
+        end (datetime-like, Optional): only load device statuses before this time (naive times are UTC)
+        columns (list, Optional): only load these columns of the devicestatus schema, default is all of them
+        ensure_index (bool, Optional): create the index on the time field if it doesn't exist, default is False
+        compact (bool, Optional): load with the compact schema (see schemas.compact_table()), with created_at
+            decoded at load time. Default is False.
 
-    Returns: a Pandas dataframe containing information from the device status collection
+    Returns: a Pandas dataframe containing information from the device status collection. With compact=True, it is
+        indexed by the (UTC) time of each status.
 
     """
-    _, _, devicestatus_schema, _ = mdb_schemas()
+    return _find_df(col_devicestatus0, "devicestatus", start, end, columns, ensure_index, compact)
+
+
+# Everything load_all() returns: a dataframe per collection, the profile documents, and per-collection load times
+LoopData = namedtuple("LoopData", ["entries", "treatments", "devicestatus", "profile", "timings"])
+
 
-    return col_devicestatus0.find_pandas_all({}, schema=devicestatus_schema)
+def _timed(load_function, *args, **kwargs):
+    """
+    Run a load function and return its result along with the wall clock time it took (seconds)
+    """
+    t_start = time.perf_counter()
+    result = load_function(*args, **kwargs)
+
+    return result, time.perf_counter() - t_start
+
+
+@instrument.timed
+def load_all(yml_secrets_file=None, collections=None, start=None, end=None, max_workers=4, compact=False,
+             names=("entries", "treatments", "devicestatus", "profile")):
+    """
+    Load entries, treatments, devicestatus and profile at the same time, each on its own thread (sharing the one
+    pooled client), so the total wait is close to that of the slowest collection rather than the sum of all of them.
+
+    Example usage:
+    loop_data = ld.load_all(yml_secrets_file, start='2023-11-01')
+    df_entries = loop_data.entries
+    print(loop_data.timings)
+
+    Args:
+        yml_secrets_file (str, Optional): path to a yml file containing the URI and mongodB name
+        collections (tuple, Optional): collections as returned by get_collections(), instead of yml_secrets_file
+        start (datetime-like, Optional): only load documents at or after this time (naive times are UTC). The profile
+            documents are always loaded in full.
+        end (datetime-like, Optional): only load documents before this time (naive times are UTC)
+        max_workers (int, Optional): number of threads, default is 4
+        compact (bool, Optional): load the dataframes with the compact schemas, indexed by time (see
+            get_entries_df()). Default is False.
+        names (tuple, Optional): only load these collections, e.g. ("entries", "profile"). Default is all four.
+
+    Returns: LoopData named tuple with entries, treatments and devicestatus dataframes, the list of profile documents,
+        and a dict of the load time of each collection (seconds), including the "total". Collections that are not in
+        names are None.
+
+    """
+    if collections is None:
+        collections = get_collections(yml_secrets_file)
+    col_entries, col_treatments, col_profile, col_devicestatus = collections
+
+    t_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        loaders = {
+            "devicestatus": (get_devicestatus_df, col_devicestatus, start, end, None, False, compact),
+            "entries": (get_entries_df, col_entries, start, end, None, False, compact),
+            "treatments": (get_treatments_df, col_treatments, start, end, None, False, compact),
+            "profile": (lambda col: list(col.find({})), col_profile),
+        }
+        futures = {name: executor.submit(_timed, *loader) for name, loader in loaders.items() if name in names}
+        results = {name: future.result() for name, future in futures.items()}
+
+    timings = {name: elapsed for name, (_, elapsed) in results.items()}
+    timings["total"] = time.perf_counter() - t_start
+
+    return LoopData(entries=results.get("entries", (None,))[0],
+                    treatments=results.get("treatments", (None,))[0],
+                    devicestatus=results.get("devicestatus", (None,))[0],
+                    profile=results.get("profile", (None,))[0],
+                    timings=timings)
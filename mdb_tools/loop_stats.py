@@ -2,155 +2,1093 @@
 
 A module for extracting and computing statistics for insulin or CGM data
 """
+import time
+import weakref
+
 import numpy as np
 import pandas as pd
 
+from mdb_tools import instrument
+
 
-def get_yeardays(time_series):
+@instrument.timed
+def get_yeardays(time_series, as_int=False, time_zone=None):
     """
     Read pandas datetime series and return a string of "year-day"
 
+    With as_int=True, return compact integer day keys instead: the number of days since 1970-01-01 of each (local)
+    time, computed directly from the timestamps. These group and join much faster than strings, and convert back to
+    dates with yearday_keys_to_dates().
+
     Args:
         time_series (series): Pandas series constructed from glooko data. Time column must be in Pandas datetime format.
+        as_int (bool, Optional): return integer day keys instead of "year-day" strings, default is False
+        time_zone (str, Optional): time zone that defines the day boundaries. Default (None) uses the time zone of
+            time_series as it is. Time zone naive times are taken as UTC when a time zone is requested.
 
     Returns:
-        pandas series: year-day
+        pandas series: year-day (str), or days since 1970-01-01 (int32) if as_int is True
 
     """
+    if time_zone is not None:
+        times = pd.DatetimeIndex(time_series)
+        times = times.tz_localize('UTC') if times.tz is None else times
+        time_series = pd.Series(times.tz_convert(time_zone), index=getattr(time_series, 'index', None))
+
+    if as_int:
+        times = pd.DatetimeIndex(time_series)
+        if times.tz is not None:
+            times = times.tz_localize(None)
+        day_keys = (times.asi8 // (86400 * 1_000_000_000)).astype('int32')
+        return pd.Series(day_keys, index=getattr(time_series, 'index', None))
+
     day_of_year = time_series.dt.dayofyear
     year = time_series.dt.year
 
     return year.astype(str) + '-' + day_of_year.map('{:03.0f}'.format)
 
 
+def yearday_keys_to_dates(day_keys):
+    """
+    Convert integer day keys (see get_yeardays()) back to dates
+
+    Args:
+        day_keys (array-like): days since 1970-01-01
+
+    Returns: (DatetimeIndex) midnight of each day, time zone naive
+
+    """
+    return pd.DatetimeIndex(np.asarray(day_keys, dtype='int64').astype('datetime64[D]').astype('datetime64[ns]'))
+
+
+def _schedule_arrays(schedule):
+    """
+    Convert a profile schedule (list of {"time": "HH:MM", "value": x} items) into sorted arrays
+
+    Args:
+        schedule (list): a schedule from a profile "store", e.g. store["Default"]["basal"]
+
+    Returns: (tuple) seconds-in-day of each schedule slot and the value of each slot, both as numpy arrays
+
+    """
+    slot_seconds = np.array([int(item["time"].split(':')[0]) * 3600 + int(item["time"].split(':')[1]) * 60
+                             for item in schedule], dtype='int64')
+    slot_values = np.array([item["value"] for item in schedule], dtype='float64')
+
+    order = np.argsort(slot_seconds, kind='stable')
+
+    return slot_seconds[order], slot_values[order]
+
+
+def _utc_offsets(times_ns, time_zone):
+    """
+    Compute the UTC offset (nanoseconds) of a time zone at each of an array of UTC times (nanoseconds)
+    """
+    local_times = pd.DatetimeIndex(times_ns, tz='UTC').tz_convert(time_zone).tz_localize(None)
+
+    return local_times.asi8 - times_ns
+
+
+def _utc_offset_table(time_zone, start_ns, end_ns):
+    """
+    Build the table of UTC offsets of a time zone between two UTC times (nanoseconds): the times at which the offset
+    changes (DST transitions), and the offset in effect from each of them. Changes are found on an hourly grid, then
+    pinned down to the second.
+
+    Returns: (tuple) transition times (ns) and offsets (ns), both as numpy arrays, starting at or before start_ns
+
+    """
+    hour_ns = 3600 * 1_000_000_000
+    hours = np.arange(start_ns // hour_ns * hour_ns, end_ns + hour_ns, hour_ns, dtype='int64')
+    hour_offsets = _utc_offsets(hours, time_zone)
+
+    transition_ns = [hours[0]]
+    offsets = [hour_offsets[0]]
+    for change in np.flatnonzero(np.diff(hour_offsets) != 0):
+        seconds = hours[change] + np.arange(1, 3601, dtype='int64') * 1_000_000_000
+        second_offsets = _utc_offsets(seconds, time_zone)
+        first_changed = np.argmax(second_offsets != hour_offsets[change])
+        transition_ns.append(seconds[first_changed])
+        offsets.append(second_offsets[first_changed])
+
+    return np.array(transition_ns, dtype='int64'), np.array(offsets, dtype='int64')
+
+
+def _local_seconds_in_day(times_ns, time_zone, offset_table=None):
+    """
+    Compute the local (wall clock) seconds elapsed in the day for an array of UTC times
+
+    Args:
+        times_ns (numpy array): UTC times in nanoseconds since the epoch (int64)
+        time_zone (str): time zone name, e.g. "US/Eastern"
+        offset_table (tuple, Optional): UTC offset table of the time zone covering the times (see
+            _utc_offset_table()), so that each time's offset is a binary search instead of a time zone conversion.
+            Default (None) converts the times with pandas.
+
+    Returns: (numpy array) seconds elapsed since local midnight for each time
+
+    """
+    if offset_table is None:
+        offsets = _utc_offsets(times_ns, time_zone)
+    else:
+        transition_ns, table_offsets = offset_table
+        offsets = table_offsets[np.maximum(np.searchsorted(transition_ns, times_ns, side='right') - 1, 0)]
+
+    return ((times_ns + offsets) // 1_000_000_000) % 86400
+
+
+def _to_utc_nanoseconds(in_times):
+    """
+    Convert an array of requested times into UTC nanoseconds since the epoch. Time zone naive times are treated as UTC.
+
+    Args:
+        in_times (array-like): An array of times in pandas datetime format
+
+    Returns: (numpy array) int64 nanoseconds since the epoch
+
+    """
+    in_times = pd.DatetimeIndex(in_times)
+    if in_times.tz is None:
+        in_times = in_times.tz_localize('UTC')
+
+    return in_times.asi8
+
+
+class ProfileTimeline:
+    """
+    Every profile document compiled into sorted, array-backed schedules so that any setting can be looked up at any
+    number of times without going back to the database.
+
+    Schedules are compiled the first time a profile name / setting pair is requested and kept for later requests.
+    Use get_profile_timeline() to get a timeline that is memoized per profile collection.
+
+    Example usage:
+    timeline = ProfileTimeline.from_collection(col_profile)
+    basal = timeline.setting_at_times(df_entries.index, req_setting="basal")
+
+    Args:
+        prof_docs (list): profile documents (dicts with "mills" and "store" keys)
+
+    """
+
+    def __init__(self, prof_docs):
+        # Sort the documents by time (the collection's natural order is not guaranteed to be chronological)
+        self.prof_docs = sorted(prof_docs, key=lambda doc: int(doc["mills"]))
+        self.latest_mills = int(self.prof_docs[-1]["mills"]) if self.prof_docs else None
+
+        # Compiled schedules, keyed by (profile name, setting)
+        self._schedules = {}
+
+        # UTC offset tables (see _utc_offset_table()), keyed by time zone, with the UTC time range each one covers
+        self._offset_tables = {}
+
+    @classmethod
+    def from_collection(cls, col_prof):
+        """
+        Build a timeline from every document in a profile collection
+
+        Args:
+            col_prof (mongodb collection): profile collection
+
+        Returns: ProfileTimeline
+
+        """
+        return cls(list(col_prof.find({})))
+
+    def profile_names(self):
+        """
+        Returns: (list) every profile name that appears in any document's "store"
+        """
+        return sorted({name for doc in self.prof_docs for name in doc["store"].keys()})
+
+    def schedule(self, req_setting="carbratio", req_profile="Default"):
+        """
+        Get (compiling if needed) the array-backed schedule for one profile name and setting
+
+        Every document's schedule is laid end to end: slot keys for document n are n * 86400 + seconds-in-day.
+
+        Args:
+            req_setting (str): requested profile setting. Can be "carbratio", "sens", or "basal"
+            req_profile (str): requested profile name. Default is "Default".
+
+        Returns: (dict) numpy arrays "doc_times" (ns), "doc_tz", "time_zones" (unique), "doc_tz_code" (index of each
+            document's time zone in time_zones), "slot_keys", "slot_values", "slot_doc" and "doc_last_slot"
+
+        """
+        key = (req_profile, req_setting)
+        if key in self._schedules:
+            return self._schedules[key]
+
+        # Only keep the documents that include the requested profile
+        prof_docs = [doc for doc in self.prof_docs if req_profile in doc["store"]]
+        if len(prof_docs) == 0:
+            raise Exception("The requested profile, " + req_profile + ", is not in any profile document")
+
+        slot_keys = []
+        slot_values = []
+        doc_last_slot = np.zeros(len(prof_docs), dtype='int64')
+        n_slots = 0
+        for doc_num, doc in enumerate(prof_docs):
+            prof_info = doc["store"][req_profile]
+            if req_setting not in prof_info.keys():
+                raise Exception(
+                    "The requested setting, " + req_setting + ", is not one of: " + ', '.join(list(prof_info.keys())))
+            seconds, values = _schedule_arrays(prof_info[req_setting])
+            slot_keys.append(doc_num * 86400 + seconds)
+            slot_values.append(values)
+            n_slots += len(seconds)
+            doc_last_slot[doc_num] = n_slots - 1
+        slot_keys = np.concatenate(slot_keys)
+
+        doc_tz = np.array([doc["store"][req_profile]['timezone'] for doc in prof_docs])
+        time_zones, doc_tz_code = np.unique(doc_tz, return_inverse=True)
+
+        compiled = {
+            "doc_times": np.array([int(doc["mills"]) for doc in prof_docs], dtype='int64') * 1_000_000,
+            "doc_tz": doc_tz,
+            "time_zones": time_zones,
+            "doc_tz_code": doc_tz_code,
+            "slot_keys": slot_keys,
+            "slot_values": np.concatenate(slot_values),
+            "slot_doc": slot_keys // 86400,
+            "doc_last_slot": doc_last_slot,
+        }
+        self._schedules[key] = compiled
+
+        return compiled
+
+    def offset_table(self, time_zone, start_ns, end_ns):
+        """
+        Get the UTC offset table of a time zone covering a range of UTC times (nanoseconds), building it (or widening
+        the cached one) if needed
+
+        Returns: (tuple) transition times (ns) and offsets (ns), see _utc_offset_table()
+
+        """
+        cached = self._offset_tables.get(time_zone)
+        if cached is not None and cached[0] <= start_ns and end_ns <= cached[1]:
+            return cached[2]
+
+        if cached is not None:
+            start_ns, end_ns = min(start_ns, cached[0]), max(end_ns, cached[1])
+        table = _utc_offset_table(time_zone, start_ns, end_ns)
+        self._offset_tables[time_zone] = (start_ns, end_ns, table)
+
+        return table
+
+    def setting_at_times(self, in_times, req_setting="carbratio", req_profile="Default"):
+        """
+        Look up the requested profile setting at the requested times
+
+        The profile document in effect at each requested time is found with a single binary search over the sorted
+        document times, and the schedule slot in effect is found with a second binary search over all of the
+        schedules laid end to end. Local times come from each time zone's table of UTC offsets (one more binary
+        search), so no time zone conversion is done per requested time. Requested times that come before the first
+        profile document use the first document. Time zone naive requested times are treated as UTC.
+
+        Args:
+            in_times (array-like): An array of input / requested times in pandas datetime format
+            req_setting (str): requested profile setting. Can be "carbratio", "sens", or "basal"
+            req_profile (str): requested profile name. Default is "Default".
+
+        Returns: (numpy array) requested setting at the requested date/times
+
+        """
+        compiled = self.schedule(req_setting, req_profile)
+        in_times_unix = _to_utc_nanoseconds(in_times)
+
+        # ##### First pass: find the most recent profile document at each requested time #####
+        doc_idx = np.searchsorted(compiled["doc_times"], in_times_unix, side='right') - 1
+        doc_idx[doc_idx < 0] = 0
+
+        # ##### Compute local seconds in day, one time zone at a time #####
+        req_tz_code = compiled["doc_tz_code"][doc_idx]
+        tz_counts = np.bincount(req_tz_code, minlength=len(compiled["time_zones"]))
+        seconds_in_day = np.zeros(len(in_times_unix), dtype='int64')
+        for tz_code in np.flatnonzero(tz_counts):
+            time_zone = compiled["time_zones"][tz_code]
+            # Most requests only touch one time zone, which needs no mask
+            tz_mask = slice(None) if tz_counts[tz_code] == len(in_times_unix) else req_tz_code == tz_code
+            tz_times = in_times_unix[tz_mask]
+            offset_table = self.offset_table(time_zone, tz_times.min(), tz_times.max())
+            seconds_in_day[tz_mask] = _local_seconds_in_day(tz_times, time_zone, offset_table)
+
+        # ##### Second pass: find the schedule slot in effect at each requested time #####
+        slot_idx = np.searchsorted(compiled["slot_keys"], doc_idx * 86400 + seconds_in_day, side='right') - 1
+
+        # Times before a document's first slot of the day wrap around to that document's last slot (previous evening)
+        wrapped = (slot_idx < 0) | (compiled["slot_doc"][np.maximum(slot_idx, 0)] != doc_idx)
+        slot_idx[wrapped] = compiled["doc_last_slot"][doc_idx[wrapped]]
+
+        return compiled["slot_values"][slot_idx]
+
+    def schedule_breakpoints(self, start, end, req_setting="basal", req_profile="Default"):
+        """
+        Every time between start and end at which the requested setting can change: the profile document times, and
+        the (local) start of every schedule slot on every day, in each time zone used by the documents. Slot starts
+        that fall in a DST gap are moved forward to the end of the gap, and ones that happen twice (DST fall back) are
+        included twice.
+
+        Args:
+            start (datetime-like): start of the period (naive times are UTC)
+            end (datetime-like): end of the period (naive times are UTC)
+            req_setting (str, Optional): requested profile setting, default is "basal"
+            req_profile (str, Optional): requested profile name. Default is "Default".
+
+        Returns: (numpy array) sorted, unique UTC times in nanoseconds (int64) within [start, end]
+
+        """
+        compiled = self.schedule(req_setting, req_profile)
+        start_ns, end_ns = _to_utc_nanoseconds([start, end])
+        slot_seconds = np.unique(compiled["slot_keys"] % 86400)
+
+        breakpoints = [compiled["doc_times"]]
+        for time_zone in np.unique(compiled["doc_tz"]):
+            # Every local day that overlaps the period, padded by a day on either side
+            local_bounds = pd.DatetimeIndex([start_ns, end_ns], tz='UTC').tz_convert(time_zone).tz_localize(None)
+            local_days = pd.date_range(local_bounds[0].normalize() - pd.Timedelta(days=1),
+                                       local_bounds[1].normalize() + pd.Timedelta(days=1), freq='D')
+            wall_times = pd.DatetimeIndex((local_days.asi8[:, None] + slot_seconds[None, :] * 1_000_000_000).ravel())
+            for ambiguous in [True, False]:
+                local_times = wall_times.tz_localize(time_zone, ambiguous=np.full(len(wall_times), ambiguous),
+                                                     nonexistent='shift_forward')
+                breakpoints.append(local_times.asi8)
+
+        breakpoints = np.unique(np.concatenate(breakpoints))
+
+        return breakpoints[(breakpoints >= start_ns) & (breakpoints <= end_ns)]
+
+
+# Memoized timelines: {id(client): (weak reference to the client, {collection full name: (timeline, last check)})}.
+# The weak reference tells a live client apart from a closed one whose id() has been reused.
+_timeline_cache = {}
+
+
+def _client_timelines(client):
+    """
+    Get the memoized timelines of a client, starting a fresh (empty) set if the client hasn't been seen before
+    """
+    key = id(client)
+    cached = _timeline_cache.get(key)
+    if cached is None or cached[0]() is not client:
+        cached = (weakref.ref(client, lambda _, key=key: _timeline_cache.pop(key, None)), {})
+        _timeline_cache[key] = cached
+
+    return cached[1]
+
+
+def clear_profile_timelines(client=None):
+    """
+    Forget memoized timelines (see get_profile_timeline()), e.g. when a client is closed
+
+    Args:
+        client (mongodb client, Optional): only forget the timelines of this client. Default (None) forgets them all.
+
+    """
+    if client is None:
+        _timeline_cache.clear()
+    else:
+        cached = _timeline_cache.get(id(client))
+        if cached is not None and cached[0]() is client:
+            del _timeline_cache[id(client)]
+
+
+@instrument.timed
+def get_profile_timeline(col_prof, refresh=False):
+    """
+    Get the ProfileTimeline for a profile collection, building it the first time the collection is seen.
+
+    Later calls reuse the cached timeline without querying the database. To pick up profile documents added since,
+    pass refresh: a single query for documents with a newer "mills" than the newest cached document is made, and the
+    timeline is only rebuilt if one turns up.
+
+    Args:
+        col_prof (mongodb collection): profile collection
+        refresh (bool or num, Optional): True to check the collection for newer profile documents (one round trip),
+            or a number of seconds to only check if the last check was longer ago than that. Default is False (never
+            check).
+
+    Returns: ProfileTimeline
+
+    """
+    timelines = _client_timelines(col_prof.database.client)
+    cached = timelines.get(col_prof.full_name)
+    now = time.monotonic()
+
+    if cached is None:
+        timeline, checked = ProfileTimeline.from_collection(col_prof), now
+    else:
+        timeline, checked = cached
+        if refresh is True or (refresh is not False and now - checked >= refresh):
+            query = {} if timeline.latest_mills is None else {"mills": {"$gt": timeline.latest_mills}}
+            new_docs = list(col_prof.find(query))
+            if len(new_docs) > 0:
+                timeline = ProfileTimeline(timeline.prof_docs + new_docs)
+            checked = now
+
+    timelines[col_prof.full_name] = (timeline, checked)
+
+    return timeline
+
+
+@instrument.timed
 def get_setting_at_times(in_times, col_prof, req_setting="carbratio", req_profile="Default"):
     """
     A function that returns the requested profile setting from a profile collection at requested times
 
+    Profile documents are compiled once per collection (see get_profile_timeline()), so repeated calls for different
+    settings or subsets of times do not query, download or re-parse the profile collection. Profile documents added
+    after the first call are not seen until get_profile_timeline(col_prof, refresh=True) is called.
+
     Args:
         in_times (array-like): An array of input / requested times in pandas datetime format
-        col_prof (mongodb collection): profile collection that includes the carb ratios
+        col_prof (mongodb collection or ProfileTimeline): profile collection that includes the carb ratios, or a
+            timeline already built from one
         req_setting (str): requested profile setting. Can be "carbratio", "sens", or "basal"
         req_profile (str): requested profile name. Default is "Default".
 
     Returns: (list) requested setting at the requested date/times
 
     """
-    # ##### Prep time variables #####
+    if isinstance(col_prof, ProfileTimeline):
+        timeline = col_prof
+    else:
+        timeline = get_profile_timeline(col_prof)
+
+    return timeline.setting_at_times(in_times, req_setting, req_profile).tolist()
 
-    # Convert in_times array to series (if it isn't already)
-    in_times = pd.Series(in_times)
 
-    # Convert requested input times to unix
-    in_times_unix = in_times.view('int64')
+def _treatment_times(df_treatments):
+    """
+    Get treatment times in UTC nanoseconds, from a datetime "time" column or index if there is one, otherwise by
+    parsing the "timestamp" (or "created_at") strings
+    """
+    if "time" in df_treatments.columns:
+        return _to_utc_nanoseconds(df_treatments["time"])
+    if isinstance(df_treatments.index, pd.DatetimeIndex):
+        return _to_utc_nanoseconds(df_treatments.index)
+    time_strings = df_treatments["timestamp"].fillna(df_treatments["created_at"])
+
+    return pd.DatetimeIndex(pd.to_datetime(time_strings, utc=True, format='ISO8601')).asi8
 
-    # # Compute seconds elapsed in current day (to get at the current carb ratio)
-    # seconds_in_day = in_times.dt.hour * 3600 + in_times.dt.minute * 60 + in_times.dt.second
 
-    # ##### Prep profile documents #####
+@instrument.timed
+def daily_insulin_totals(df_treatments, col_prof, start, end, time_zone='UTC', req_profile="Default"):
+    """
+    Insulin delivered per local day: scheduled basal, the change to it from temp basals, and boluses.
 
-    # Dump every profile document into a list
-    prof_docs_all = [prof for prof in col_prof.find({})]
+    Scheduled basal and temp basals are treated as time intervals. The period is cut at every point where the
+    delivered rate can change (local midnights, schedule slot starts, profile changes, temp basal starts and ends),
+    and the rate in each piece is integrated exactly. A temp basal ends at its start plus its duration, or when the
+    next temp basal starts if that is sooner (so a zero-duration temp basal cancels the one before it). Because the
+    cuts are made in UTC, days that are 23 or 25 hours long (DST) get the right amount of basal.
 
-    # Get all the time stamps and convert to unix time (nanoseconds)
-    prof_time_unix = [int(prof["mills"]) * 1e6 for prof in prof_docs_all]
+    Example usage:
+    df_insulin = daily_insulin_totals(df_treatments, col_profile, '2023-09-27', '2023-12-31', time_zone='US/Eastern')
 
-    # Get all the "store" items in each document
-    all_store = [doc["store"] for doc in prof_docs_all]
+    Args:
+        df_treatments (dataframe): treatments (see load_data.get_treatments_df()), with "eventType", "absolute",
+            "rate", "duration" (minutes) and "insulin" columns, and either a datetime "time" column or "timestamp" /
+            "created_at" strings
+        col_prof (mongodb collection or ProfileTimeline): profile collection, or a timeline already built from one
+        start (datetime-like): first day. Time zone naive times are local times in time_zone.
+        end (datetime-like): end of the period (exclusive). Time zone naive times are local times in time_zone.
+        time_zone (str, Optional): time zone that defines the days, default is "UTC"
+        req_profile (str, Optional): requested profile name. Default is "Default".
 
-    # Pull out all the keys for each "store"
-    store_keys = [x.keys() for x in all_store]
+    Returns: pandas dataframe indexed by date, with columns basal (scheduled), basal_adjust (temp basal change),
+        basal_total, bolus and insulin_sum (all in units of insulin)
 
-    # # Extract the "store" info for each document, for any available profiles
-    # all_store_vals = [[doc[key] for key in store_keys[doc_num]] for doc_num, doc in enumerate(all_store)]
+    """
+    timeline = col_prof if isinstance(col_prof, ProfileTimeline) else get_profile_timeline(col_prof)
 
-    # Extract the profile names for each document
-    all_store_profiles = [[key for key in store_keys[doc_num]] for doc_num, doc in enumerate(all_store)]
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    start = start.tz_localize(time_zone) if start.tz is None else start
+    end = end.tz_localize(time_zone) if end.tz is None else end
+    start_ns, end_ns = _to_utc_nanoseconds([start, end])
 
-    # ##### Next, figure out which profile is appropriate for each requested time #####
+    # ##### Temp basals as intervals #####
+    treatment_times = _treatment_times(df_treatments)
+    is_temp = (df_treatments["eventType"] == "Temp Basal").to_numpy(dtype=bool, na_value=False)
+    order = np.argsort(treatment_times[is_temp], kind='stable')
+    temp_rates = df_treatments["absolute"].fillna(df_treatments["rate"]).to_numpy(dtype='float64', na_value=np.nan)
+    temp_minutes = df_treatments["duration"].fillna(0).to_numpy(dtype='float64', na_value=0)
 
-    # Get the indices of the most "recent" documents from the collection. Only keep the ones for the requested profile.
-    doc_idx = [(len([in_time - t for t_idx, t in enumerate(prof_time_unix) if
-                     (in_time - t >= 0) & (req_profile in all_store_profiles[t_idx])]) - 1) for in_time in
-               in_times_unix]
+    # The first "temp basal" is a placeholder that is never active, so every time has one to look up
+    no_time = np.iinfo('int64').min
+    temp_start = np.concatenate([[no_time], treatment_times[is_temp][order]])
+    temp_rate = np.concatenate([[np.nan], temp_rates[is_temp][order]])
+    temp_end = np.concatenate([[no_time], temp_start[1:] + (temp_minutes[is_temp][order] * 60e9).astype('int64')])
 
-    # Profile info for each requested time
-    requested_prof_info = [[all_store[this_doc][prof] for prof in all_store_profiles[this_doc]] for this_doc in doc_idx]
+    # A temp basal is cut short by the next one
+    temp_end[:-1] = np.minimum(temp_end[:-1], temp_start[1:])
 
-    val_req = []
-    for idx, prof_info in enumerate(requested_prof_info):
-        if req_setting in prof_info[0].keys():
-            carb_ratio = prof_info[0][req_setting]
-        else:
-            raise Exception(
-                "The requested setting, " + req_setting + ", is not one of: " + ', '.join(list(prof_info[0].keys())))
+    # ##### Cut the period wherever the delivered rate can change #####
+    local_midnights = pd.date_range(start.tz_convert(time_zone).normalize(), end.tz_convert(time_zone),
+                                    freq='D').asi8
+    breakpoints = np.concatenate([
+        [start_ns, end_ns],
+        local_midnights,
+        timeline.schedule_breakpoints(start, end, "basal", req_profile),
+        temp_start,
+        temp_end,
+    ])
+    breakpoints = np.unique(breakpoints[(breakpoints >= start_ns) & (breakpoints <= end_ns)])
+    seg_start = breakpoints[:-1]
+    seg_hours = np.diff(breakpoints) / 3.6e12
 
-        # Ensure that the input time zone (CGM) matches the profile/treatment time zone
-        this_req_time_in = in_times.iloc[idx].tz_convert(prof_info[0]['timezone'])
-        this_req_time = this_req_time_in.hour * 3600 + this_req_time_in.minute * 60 + this_req_time_in.second
+    # ##### Rate in each piece #####
+    scheduled_rate = timeline.setting_at_times(seg_start, "basal", req_profile)
+    temp_idx = np.searchsorted(temp_start, seg_start, side='right') - 1
+    in_temp = (seg_start < temp_end[temp_idx]) & ~np.isnan(temp_rate[temp_idx])
+    delivered_rate = np.where(in_temp, temp_rate[temp_idx], scheduled_rate)
 
-        # Convert treatment time to seconds in day using hours and minutes
-        times = [int(cr["time"].split(':')[0]) * 3600 + int(cr["time"].split(':')[1]) * 60 for cr in carb_ratio]
-        crs = [cr["value"] for cr in carb_ratio]
+    # ##### Integrate per local day #####
+    seg_days = get_yeardays(pd.DatetimeIndex(seg_start, tz='UTC'), as_int=True, time_zone=time_zone).values
+    basal = pd.Series(scheduled_rate * seg_hours).groupby(seg_days).sum()
+    basal_adjust = pd.Series((delivered_rate - scheduled_rate) * seg_hours).groupby(seg_days).sum()
 
-        t_diff = [this_req_time - t for t in times]
+    # ##### Boluses #####
+    bolus_insulin = df_treatments["insulin"].to_numpy(dtype='float64', na_value=np.nan)
+    is_bolus = ~np.isnan(bolus_insulin) & (treatment_times >= start_ns) & (treatment_times < end_ns)
+    bolus_days = get_yeardays(pd.DatetimeIndex(treatment_times[is_bolus], tz='UTC'), as_int=True,
+                              time_zone=time_zone).values
+    bolus = pd.Series(bolus_insulin[is_bolus]).groupby(bolus_days).sum()
 
-        val_req.append([crs[idx] for idx, x in enumerate(t_diff) if x >= 0][-1])
+    df_insulin = pd.DataFrame({"basal": basal, "basal_adjust": basal_adjust})
+    df_insulin["bolus"] = bolus.reindex(df_insulin.index).fillna(0)
+    df_insulin["basal_total"] = df_insulin["basal"] + df_insulin["basal_adjust"]
+    df_insulin["insulin_sum"] = df_insulin["basal_total"] + df_insulin["bolus"]
+    df_insulin.index = yearday_keys_to_dates(df_insulin.index)
+    df_insulin.index.name = "date"
 
-    return val_req
+    return df_insulin
+
+
+@instrument.timed
+def bg_histogram(time_vec, cgm_data, bins=np.arange(40, 410, 10), by="day", time_zone=None):
+    """
+    Count CGM readings per blood glucose bin, for every day (or every hour of the day), in one pass over the readings.
+
+    Bins follow numpy.histogram: each bin includes its left edge, the last bin also includes its right edge, and
+    readings outside the bins (or missing) are not counted.
+
+    Example usage:
+    df_hist = bg_histogram(df_entries.index, df_entries['sgv'], time_zone='US/Eastern')
+    hv.QuadMesh((df_hist.index, df_hist.columns + 5, df_hist.values.T))
+
+    Args:
+        time_vec (array-like): array or list or series of times
+        cgm_data (array-like): array or list or series of CGM values at each point in time_vec
+        bins (array-like, Optional): bin edges in mg/dL, default is 40 to 400 in steps of 10
+        by (str, Optional): "day" for one row per day, or "hour" for one row per hour of the day. Default is "day".
+        time_zone (str, Optional): time zone that defines the days / hours. Default (None) uses the time zone of
+            time_vec as it is.
+
+    Returns: pandas dataframe of counts, indexed by date (or hour), with the left edge of each bin as the columns
+
+    """
+    bins = np.asarray(bins, dtype='float64')
+    bg = np.asarray(cgm_data, dtype='float64')
+    n_bins = len(bins) - 1
+
+    if by == "day":
+        row_keys = get_yeardays(pd.DatetimeIndex(time_vec), as_int=True, time_zone=time_zone).values
+    elif by == "hour":
+        times = pd.DatetimeIndex(time_vec)
+        if time_zone is not None:
+            times = (times.tz_localize('UTC') if times.tz is None else times).tz_convert(time_zone)
+        row_keys = times.hour.values
+    else:
+        raise Exception("The requested grouping, " + by + ", is not one of: day, hour")
+
+    # Bin of each reading (the last bin is closed on the right)
+    bin_idx = np.searchsorted(bins, bg, side='right') - 1
+    bin_idx[bg == bins[-1]] = n_bins - 1
+    counted = (bin_idx >= 0) & (bin_idx < n_bins) & ~np.isnan(bg)
+
+    rows, row_idx = np.unique(row_keys[counted], return_inverse=True)
+    counts = np.bincount(row_idx * n_bins + bin_idx[counted], minlength=len(rows) * n_bins).reshape(len(rows), n_bins)
+
+    index = yearday_keys_to_dates(rows) if by == "day" else pd.Index(rows)
+    index.name = "date" if by == "day" else "hour"
+
+    return pd.DataFrame(counts, index=index, columns=bins[:-1])
+
+
+def merge_bg_histograms(*histograms):
+    """
+    Combine histograms from bg_histogram() (e.g. the history so far and the readings that came in since), adding up
+    the counts of any days that appear in more than one. The histograms must use the same bins.
+
+    Args:
+        *histograms (dataframe): histograms from bg_histogram()
+
+    Returns: pandas dataframe of counts
+
+    """
+    df_merged = histograms[0]
+    for df_hist in histograms[1:]:
+        df_merged = df_merged.add(df_hist, fill_value=0)
+
+    return df_merged.astype('int64').sort_index()
+
+
+def _thin_times(sorted_times, tolerance_ns):
+    """
+    Mask of the sorted times to keep, dropping each time that is within the tolerance of the previous kept one.
+    Only the times within the tolerance of their neighbour need to be walked through one at a time; every other time
+    is kept.
+    """
+    keep = np.ones(len(sorted_times), dtype=bool)
+    last_kept = None
+    for idx in np.flatnonzero(np.diff(sorted_times) <= tolerance_ns) + 1:
+        if keep[idx - 1]:
+            last_kept = sorted_times[idx - 1]
+        keep[idx] = sorted_times[idx] - last_kept > tolerance_ns
+
+    return keep
+
+
+@instrument.timed
+def dedupe_entries(df_entries, priority=None, tolerance='150s'):
+    """
+    Remove duplicate CGM readings that were uploaded by more than one source (e.g. Loop and the Dexcom app).
+
+    Sources are taken in priority order. A reading from each later source is only kept if no already-kept reading is
+    within the tolerance of it, so secondary sources just fill the gaps of the primary one. Within each source, a
+    reading within the tolerance of the previous kept reading from that source is dropped too (repeat uploads).
+
+    Example usage:
+    df_entries = dedupe_entries(df_entries0, priority=["loop://Dexcom/G6/21.0"])
+
+    Args:
+        df_entries (dataframe): entries (see load_data.get_entries_df()) with a "device" column and either a numeric
+            "date" column (ms), a datetime "time" column or a datetime index
+        priority (list, Optional): devices in order of preference. Devices that are not listed come after, most
+            readings first. Default (None) ranks every device by its number of readings.
+        tolerance (str or Timedelta, Optional): readings closer together than this are duplicates, default is 150s
+            (half of the 5 minute CGM interval)
+
+    Returns: pandas dataframe with the kept rows of df_entries, sorted by time
+
+    """
+    if "date" in df_entries.columns:
+        times = df_entries["date"].to_numpy(dtype='int64') * 1_000_000
+    elif "time" in df_entries.columns:
+        times = _to_utc_nanoseconds(df_entries["time"])
+    else:
+        times = _to_utc_nanoseconds(df_entries.index)
+    tolerance_ns = pd.Timedelta(tolerance).value
+
+    devices = df_entries["device"].astype(object).fillna("unknown").to_numpy(dtype=object)
+    device_counts = pd.Series(devices).value_counts()
+    priority = [] if priority is None else [device for device in priority if device in device_counts.index]
+    ranked = priority + [device for device in device_counts.index if device not in priority]
+
+    kept_rows = []
+    kept_times = np.array([], dtype='int64')
+    for rank, device in enumerate(ranked):
+        rows = np.flatnonzero(devices == device)
+        rows = rows[np.argsort(times[rows], kind='stable')]
+        device_times = times[rows]
+
+        # Nearest already-kept reading on either side
+        if rank > 0 and len(kept_times) > 0:
+            after = np.searchsorted(kept_times, device_times)
+            gap_before = device_times - kept_times[np.maximum(after - 1, 0)]
+            gap_after = kept_times[np.minimum(after, len(kept_times) - 1)] - device_times
+            gap_before[after == 0] = np.iinfo('int64').max
+            gap_after[after == len(kept_times)] = np.iinfo('int64').max
+            fills_gap = np.minimum(gap_before, gap_after) > tolerance_ns
+            rows, device_times = rows[fills_gap], device_times[fills_gap]
+
+        # Repeats from the same device
+        is_new = _thin_times(device_times, tolerance_ns)
+        rows, device_times = rows[is_new], device_times[is_new]
+
+        kept_rows.append(rows)
+        kept_times = np.sort(np.concatenate([kept_times, device_times]))
+
+    kept_rows = np.concatenate(kept_rows) if len(kept_rows) > 0 else np.array([], dtype='int64')
+    kept_rows = kept_rows[np.argsort(times[kept_rows], kind='stable')]
+
+    return df_entries.iloc[kept_rows]
 
 
 def get_last_doc(col):
     """
-    Get the last/most recent document in the collection
+    Get the last/most recent document in the collection (by its time field, see load_data.get_latest_docs())
+    """
+    from mdb_tools.load_data import get_latest_docs
+
+    return get_latest_docs(col)[0]
+
+
+@instrument.timed
+def get_pod_changes(df_devicestatus, pairing_flag='Finish Pairing'):
+    """
+    Find pod change times in device status data: the device statuses whose reservoir display override says the pod
+    is being paired.
+
+    Args:
+        df_devicestatus (dataframe): device statuses (see load_data.get_devicestatus_df()), with either a nested
+            "pump" column or a flattened "pump.reservoir_display_override" column, and either a datetime "time" column
+            or a "created_at" column
+        pairing_flag (str, Optional): reservoir display override that marks a pod change, default is 'Finish Pairing'
+
+    Returns: (DatetimeIndex) sorted pod change times
+
+    """
+    if "pump.reservoir_display_override" in df_devicestatus.columns:
+        override = df_devicestatus["pump.reservoir_display_override"]
+    else:
+        override = df_devicestatus["pump"].str.get('reservoir_display_override')
+    is_change = (override == pairing_flag).to_numpy(dtype=bool, na_value=False)
+
+    if "time" in df_devicestatus.columns:
+        change_times = pd.DatetimeIndex(df_devicestatus["time"][is_change])
+    else:
+        change_times = pd.DatetimeIndex(pd.to_datetime(df_devicestatus["created_at"].values[is_change], utc=True,
+                                                      format='ISO8601'))
+
+    return change_times.sort_values()
+
+
+@instrument.timed
+def tag_pod_sessions(in_times, pod_change_times, wrap_hours=72):
+    """
+    Tag each requested time with the pod session it falls in and the age of the pod at that time
+
+    Each time is matched to the most recent pod change with a binary search over the sorted pod change times. Times
+    before the first pod change get a session of -1 and missing ages.
+
+    Example usage:
+    pod_changes = get_pod_changes(df_devicestatus)
+    df_pods = tag_pod_sessions(df_entries.index, pod_changes)
+
+    Args:
+        in_times (array-like): An array of input / requested times in pandas datetime format
+        pod_change_times (array-like): pod change times, e.g. from get_pod_changes()
+        wrap_hours (num, Optional): nominal pod life in hours, used to wrap ages of pods that were worn longer
+            (e.g. through a missed pod change record), default is 72
+
+    Returns: pandas dataframe with one row per requested time (same index as in_times if it has one) and columns
+        pod_session, pod_times (time of the pod change), pod_age_hours, pod_age_hours_corr (wrapped age) and
+        pod_age_hours_floor (whole hours of the wrapped age)
+
+    """
+    times_unix = _to_utc_nanoseconds(in_times)
+    time_zone = pd.DatetimeIndex(in_times).tz
+    pod_times_unix = np.sort(_to_utc_nanoseconds(pod_change_times))
+
+    pod_session = np.searchsorted(pod_times_unix, times_unix, side='right') - 1
+    has_pod = pod_session >= 0
+
+    pod_times = np.full(len(times_unix), np.iinfo('int64').min, dtype='int64')
+    pod_times[has_pod] = pod_times_unix[pod_session[has_pod]]
+    pod_age_hours = np.where(has_pod, (times_unix - pod_times) / 3.6e12, np.nan)
+    pod_age_hours_corr = np.mod(pod_age_hours, wrap_hours)
+
+    index = in_times.index if isinstance(in_times, pd.Series) else None
+    if isinstance(in_times, pd.DatetimeIndex):
+        index = in_times
+
+    return pd.DataFrame({
+        "pod_session": pod_session,
+        "pod_times": pd.DatetimeIndex(pod_times, tz='UTC').tz_convert(time_zone if time_zone is not None else 'UTC'),
+        "pod_age_hours": pod_age_hours,
+        "pod_age_hours_corr": pod_age_hours_corr,
+        "pod_age_hours_floor": np.floor(pod_age_hours_corr),
+    }, index=index)
+
+
+@instrument.timed
+def daily_devicestatus_summary(batches, time_zone='UTC'):
+    """
+    Daily mean and maximum insulin on board (IOB) and carbs on board (COB), folded one batch at a time so that the
+    whole devicestatus collection never has to be in memory at once.
+
+    Example usage:
+    df_daily = daily_devicestatus_summary(ld.iter_devicestatus_batches(col_devicestatus), time_zone='US/Eastern')
+
+    Args:
+        batches (iterable): Pandas dataframes with flattened "created_at", "loop.iob.iob" and "loop.cob" columns, e.g.
+            from load_data.iter_devicestatus_batches()
+        time_zone (str, Optional): time zone that defines the day boundaries, default is "UTC"
+
+    Returns: pandas dataframe indexed by date, with iob_mean, iob_max, cob_mean and cob_max columns
+
+    """
+    value_columns = {"loop.iob.iob": "iob", "loop.cob": "cob"}
+
+    partials = []
+    for batch in batches:
+        day = pd.to_datetime(batch["created_at"], utc=True, format='ISO8601').dt.tz_convert(time_zone).dt.date
+        values = batch[list(value_columns.keys())].rename(columns=value_columns)
+        grouped = values.groupby(day.values)
+        partial = pd.concat([grouped.sum().add_suffix("_sum"), grouped.count().add_suffix("_count"),
+                             grouped.max().add_suffix("_max")], axis="columns")
+        partials.append(partial)
+
+        # Fold the partial sums together every so often, so memory stays flat for long histories
+        if len(partials) > 64:
+            partials = [_fold_daily_partials(partials)]
+
+    df_daily = _fold_daily_partials(partials)
+    for value in value_columns.values():
+        df_daily[value + "_mean"] = df_daily[value + "_sum"] / df_daily[value + "_count"]
+
+    return df_daily[["iob_mean", "iob_max", "cob_mean", "cob_max"]].rename_axis("date")
+
+
+def _fold_daily_partials(partials):
+    """
+    Combine per-day partial sums, counts and maxima (see daily_devicestatus_summary())
     """
-    return [prof for prof in col.find().skip(col.estimated_document_count() - 1)][0]
+    if len(partials) == 0:
+        return pd.DataFrame(columns=["iob_sum", "cob_sum", "iob_count", "cob_count", "iob_max", "cob_max"])
+    df_partials = pd.concat(partials)
+    grouped = df_partials.groupby(level=0)
+    df_sums = grouped[[column for column in df_partials.columns if not column.endswith("_max")]].sum()
+    df_maxes = grouped[[column for column in df_partials.columns if column.endswith("_max")]].max()
 
+    return pd.concat([df_sums, df_maxes], axis="columns")
 
-def daily_cgm_stats(time_vec, cgm_data, min_target=70, max_target=180):
+
+@instrument.timed
+def daily_cgm_stats(time_vec, cgm_data, min_target=70, max_target=180, time_zone=None):
     """
     Compute some general statistics per day including percent above, percent below, and percent in range.
 
+    All of the statistics are computed from grouped float arrays keyed by integer days (no per-day loop and no
+    per-reading strings), so the run time grows linearly with the number of readings.
+
     Args:
         time_vec (array-like): array or list or series of times
         cgm_data (array-like): array or list or series of CGM values at each point in time_vec. Must be same length as time_vec
         min_target (num, Optional): minimum blood glucose target in mg/dL, default is 70
         max_target (num, Optional): maximum blood glucose target in mg/dL, default is 180
+        time_zone (str, Optional): time zone that defines the day boundaries. Default (None) uses the time zone of
+            time_vec as it is.
 
-    Returns: pandas dataframe containing daily statistics
+    Returns: pandas dataframe containing daily statistics (count, mean, std, min, 25%, 50%, 75%, max, yearday, time,
+        pct_above, pct_below and pct_inrange), indexed by yearday
 
     """
-    yeardays = get_yeardays(time_vec)
-    df_cgm_data = pd.DataFrame(np.transpose([time_vec, yeardays, cgm_data]), columns=["time", "yearday", "bg"])
+    day_keys = get_yeardays(pd.DatetimeIndex(time_vec), as_int=True, time_zone=time_zone).values
+    bg = pd.Series(np.asarray(cgm_data, dtype='float64'))
 
     # COMPUTE STATS PER DAY
-    df_cgm_daily = df_cgm_data[["bg", "yearday"]].groupby("yearday").describe()["bg"]
-    df_cgm_daily["yearday"] = df_cgm_daily.index
-    df_cgm_daily["time"] = pd.to_datetime(df_cgm_daily['yearday'], format='%Y-%j')
-
-    unique_days = df_cgm_daily["yearday"].tolist()
-
-    # Initialize lists
-    pct_above = []
-    pct_below = []
-    pct_inrange = []
-
-    # loop through each day (I'm sure there's a fancy way to do this with Pandas but I
-    # can't figure it out...)
-    for day in unique_days:
-        df_sub = df_cgm_data[df_cgm_data["yearday"] == day]
-        this_total = len(df_sub)
-        if this_total > 0:
-            pct_above.append(sum(df_sub["bg"] > max_target) / this_total * 100)
-            pct_below.append(sum(df_sub["bg"] <= min_target) / this_total * 100)
-            pct_inrange.append(sum((df_sub["bg"] > min_target) & (df_sub["bg"] <= max_target)) / this_total * 100)
-        else:
-            pct_above.append(0)
-            pct_below.append(0)
-            pct_inrange.append(0)
-
-    df_cgm_daily["pct_above"] = pct_above
-    df_cgm_daily["pct_below"] = pct_below
-    df_cgm_daily["pct_inrange"] = pct_inrange
-
-    return df_cgm_daily.drop(['count', 'unique', 'top', 'freq'], axis='columns')
+    grouped = bg.groupby(day_keys)
+    df_cgm_daily = grouped.agg(['count', 'mean', 'std', 'min'])
+    # Reindexed so that no readings at all still gives the (empty) quantile columns
+    quantiles = grouped.quantile([0.25, 0.5, 0.75]).unstack().reindex(columns=[0.25, 0.5, 0.75])
+    df_cgm_daily[['25%', '50%', '75%']] = quantiles
+    df_cgm_daily['max'] = grouped.max()
+
+    # Percentages are out of every reading in the day (including any missing values)
+    readings_per_day = grouped.size()
+    df_cgm_daily["pct_above"] = (bg > max_target).groupby(day_keys).sum() / readings_per_day * 100
+    df_cgm_daily["pct_below"] = (bg <= min_target).groupby(day_keys).sum() / readings_per_day * 100
+    df_cgm_daily["pct_inrange"] = ((bg > min_target) & (bg <= max_target)).groupby(day_keys).sum() / readings_per_day * 100
+
+    # Only build "year-day" strings once per day
+    day_times = yearday_keys_to_dates(df_cgm_daily.index)
+    df_cgm_daily.index = day_times.strftime('%Y-%j')
+    df_cgm_daily.index.name = "yearday"
+    df_cgm_daily.insert(8, "yearday", df_cgm_daily.index)
+    df_cgm_daily.insert(9, "time", day_times)
+
+    return df_cgm_daily
+
+
+def _prediction_columns(batch):
+    """
+    Get the prediction start times (UTC nanoseconds) and the predicted values of a batch of device statuses: a pandas
+    dataframe (flattened "loop.predicted.*" columns, or a nested "loop" column) or a pyarrow Table (flattened columns).
+    Statuses without a startDate fall back on their created_at (or their time index).
+    """
+    if hasattr(batch, "column_names"):
+        batch = batch.select([name for name in batch.column_names if name.startswith("loop.predicted.")] +
+                             (["created_at"] if "created_at" in batch.column_names else []))
+        values = batch.column("loop.predicted.values").combine_chunks()
+        batch = batch.drop_columns(["loop.predicted.values"]).to_pandas()
+    elif "loop.predicted.values" in batch.columns:
+        values = batch["loop.predicted.values"]
+    else:
+        predicted = batch["loop"].str.get("predicted")
+        values = predicted.str.get("values")
+        batch = pd.DataFrame({"loop.predicted.startDate": predicted.str.get("startDate")}, index=batch.index).join(
+            batch.drop(columns=["loop"]))
+
+    if "created_at" in batch.columns:
+        fallback = pd.Series(batch["created_at"].values, dtype=object)
+    else:
+        fallback = pd.Series(batch.index, dtype=object)
+    if "loop.predicted.startDate" in batch.columns:
+        start_times = pd.Series(batch["loop.predicted.startDate"].values, dtype=object)
+        start_times = start_times.where(start_times.notna(), fallback)
+    else:
+        start_times = fallback
+
+    start_times = pd.DatetimeIndex(pd.to_datetime(start_times, utc=True, format='ISO8601'))
+
+    return start_times.asi8, values
+
+
+@instrument.timed
+def pack_predictions(df_devicestatus, n_steps=73):
+    """
+    Pack the ragged Loop glucose predictions (loop.predicted.values: one list per device status, 5 minutes apart,
+    starting at loop.predicted.startDate) into one fixed-stride 2-D array, so every horizon can be handled at once.
+
+    Example usage:
+    start_ns, predicted = pack_predictions(df_devicestatus)
+    predicted[:, 6]  # every 30 minute prediction
+
+    Args:
+        df_devicestatus (dataframe or pyarrow Table): device statuses (see load_data.get_devicestatus_df() or
+            load_data.iter_devicestatus_batches()), with flattened "loop.predicted.values" and
+            "loop.predicted.startDate" columns (or a nested "loop" column). Statuses without a startDate use their
+            created_at.
+        n_steps (int, Optional): number of prediction steps to keep, default is 73 (0 to 360 minutes)
+
+    Returns: (tuple) start time of each prediction (UTC nanoseconds, int64 numpy array), and the predicted values
+        (float32 numpy array with n_steps columns, NaN past the end of shorter predictions), for the device statuses
+        that have a prediction
+
+    """
+    start_ns, values = _prediction_columns(df_devicestatus)
+
+    if hasattr(values, "offsets"):
+        # pyarrow ListArray: the flat values and the offsets of each list are already there
+        offsets = values.offsets.to_numpy()
+        lengths = np.diff(offsets)
+        flat = values.flatten().to_numpy(zero_copy_only=False).astype('float32')
+    else:
+        values = list(values)
+        lengths = np.array([len(value) if hasattr(value, "__len__") else 0 for value in values], dtype='int64')
+        has_values = [np.asarray(value, dtype='float32') for value, length in zip(values, lengths) if length > 0]
+        flat = np.concatenate(has_values) if len(has_values) > 0 else np.array([], dtype='float32')
+
+    # Scatter the flat values into rows, cutting each list at n_steps
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    steps = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    keep = steps < n_steps
+    packed = np.full((len(lengths), n_steps), np.nan, dtype='float32')
+    packed[rows[keep], steps[keep]] = flat[keep]
+
+    has_prediction = (lengths > 0) & (start_ns != np.iinfo('int64').min)
+
+    return start_ns[has_prediction], packed[has_prediction]
+
+
+@instrument.timed
+def prediction_accuracy(batches, time_vec, cgm_data, by=("horizon",), pod_change_times=None, time_zone='UTC',
+                        n_steps=73, tolerance='150s', chunk_size=10000, wrap_hours=72):
+    """
+    How well Loop's glucose predictions matched the CGM readings that followed, by prediction horizon (and
+    optionally by the local hour of the prediction and the age of the pod).
+
+    Each prediction step is matched to the CGM reading nearest its time (within the tolerance), found with one binary
+    search over the sorted readings for a whole chunk of predictions at once. Errors are folded into running sums,
+    so memory stays bounded by chunk_size whatever the number of predictions.
+
+    Example usage:
+    df_accuracy = prediction_accuracy(ld.iter_devicestatus_batches(col_devicestatus), df_entries["time"],
+                                      df_entries["sgv"], by=("horizon", "hour"), time_zone='US/Eastern')
+
+    Args:
+        batches (dataframe or iterable): device statuses (see pack_predictions()), or an iterable of batches of them
+            (e.g. from load_data.iter_devicestatus_batches())
+        time_vec (array-like): array or list or series of CGM reading times
+        cgm_data (array-like): array or list or series of CGM values at each point in time_vec
+        by (tuple, Optional): any of "horizon" (minutes ahead), "hour" (local hour of the prediction start) and
+            "pod_age" (whole hours of pod age at the prediction start, needs pod_change_times), default is horizon
+        pod_change_times (array-like, Optional): pod change times, e.g. from get_pod_changes()
+        time_zone (str, Optional): time zone of the "hour" grouping, default is "UTC"
+        n_steps (int, Optional): number of prediction steps to score, default is 73 (0 to 360 minutes)
+        tolerance (str or Timedelta, Optional): largest gap between a prediction step and its CGM reading, default is
+            150s (half of the 5 minute CGM interval)
+        chunk_size (int, Optional): number of predictions scored at once, default is 10000
+        wrap_hours (num, Optional): nominal pod life in hours, see tag_pod_sessions(), default is 72
+
+    Returns: pandas dataframe indexed by the by groups (horizon_minutes, hour, pod_age_hours), with count, bias (mean
+        predicted - actual), mae, rmse and mard (mean absolute relative difference, %) columns
+
+    """
+    levels = {"horizon": "horizon_minutes", "hour": "hour", "pod_age": "pod_age_hours"}
+    unknown = [level for level in by if level not in levels]
+    if len(unknown) > 0:
+        raise Exception("Can't group by " + ', '.join(unknown) + ", must be some of: " + ', '.join(levels.keys()))
+
+    # ##### Sorted CGM readings #####
+    cgm_ns = _to_utc_nanoseconds(time_vec)
+    bg = np.asarray(cgm_data, dtype='float64')
+    valid = ~np.isnan(bg)
+    order = np.argsort(cgm_ns[valid], kind='stable')
+    cgm_ns, bg = cgm_ns[valid][order], bg[valid][order]
+    tolerance_ns = pd.Timedelta(tolerance).value
+
+    horizons_ns = np.arange(n_steps, dtype='int64') * 300 * 1_000_000_000
+    n_ages = int(np.ceil(wrap_hours)) + 1  # the last one is "unknown" (before the first pod change, or no pod data)
+    n_groups = n_steps * 24 * n_ages
+
+    # Running sums per (horizon, hour, pod age) group: count, error, absolute error, squared error, relative error
+    sums = np.zeros((5, n_groups), dtype='float64')
+
+    batches = [batches] if hasattr(batches, "columns") or hasattr(batches, "column_names") else batches
+    for batch in batches:
+        start_ns, predicted = pack_predictions(batch, n_steps)
+
+        for chunk_start in range(0, len(start_ns), chunk_size):
+            chunk_ns = start_ns[chunk_start:chunk_start + chunk_size]
+            chunk_predicted = predicted[chunk_start:chunk_start + chunk_size].ravel()
+
+            # ##### Nearest CGM reading to every prediction step #####
+            target_ns = (chunk_ns[:, None] + horizons_ns[None, :]).ravel()
+            after = np.minimum(np.searchsorted(cgm_ns, target_ns), max(len(cgm_ns) - 1, 0))
+            before = np.maximum(after - 1, 0)
+            if len(cgm_ns) > 0:
+                nearest = np.where(np.abs(cgm_ns[after] - target_ns) < np.abs(target_ns - cgm_ns[before]), after,
+                                   before)
+                matched = np.abs(cgm_ns[nearest] - target_ns) <= tolerance_ns
+                actual = np.where(matched, bg[nearest], np.nan)
+            else:
+                actual = np.full(len(target_ns), np.nan)
+            error = chunk_predicted - actual
+            scored = ~np.isnan(error)
+
+            # ##### Group of every prediction step #####
+            hours = _local_seconds_in_day(chunk_ns, time_zone) // 3600
+            if pod_change_times is not None:
+                pod_ages = tag_pod_sessions(pd.DatetimeIndex(chunk_ns, tz='UTC'), pod_change_times,
+                                            wrap_hours)["pod_age_hours_floor"].to_numpy()
+                ages = np.where(np.isnan(pod_ages), n_ages - 1, np.nan_to_num(pod_ages)).astype('int64')
+            else:
+                ages = np.full(len(chunk_ns), n_ages - 1, dtype='int64')
+            groups = ((np.arange(n_steps)[None, :] * 24 + hours[:, None]) * n_ages + ages[:, None]).ravel()
+
+            groups, error, actual = groups[scored], error[scored], actual[scored]
+            for row, weights in enumerate([None, error, np.abs(error), error ** 2, np.abs(error) / actual]):
+                sums[row] += np.bincount(groups, weights=weights, minlength=n_groups)
+
+    # ##### Statistics per requested group #####
+    index = pd.MultiIndex.from_product([np.arange(n_steps) * 5, np.arange(24), np.arange(n_ages)],
+                                       names=["horizon_minutes", "hour", "pod_age_hours"])
+    df_sums = pd.DataFrame(sums.T, index=index, columns=["count", "error", "abs_error", "sq_error", "rel_error"])
+    df_sums = df_sums[df_sums["count"] > 0].reset_index()
+    df_sums["pod_age_hours"] = df_sums["pod_age_hours"].where(df_sums["pod_age_hours"] < n_ages - 1)
+    df_sums = df_sums.groupby([levels[level] for level in by], dropna=False)[
+        ["count", "error", "abs_error", "sq_error", "rel_error"]].sum()
+
+    df_accuracy = pd.DataFrame({
+        "count": df_sums["count"].astype('int64'),
+        "bias": df_sums["error"] / df_sums["count"],
+        "mae": df_sums["abs_error"] / df_sums["count"],
+        "rmse": np.sqrt(df_sums["sq_error"] / df_sums["count"]),
+        "mard": df_sums["rel_error"] / df_sums["count"] * 100,
+    })
+
+    return df_accuracy
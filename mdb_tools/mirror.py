@@ -0,0 +1,308 @@
+"""mirror.py
+Keep a local Parquet copy of the Loop collections, and bring it up to date incrementally.
+
+Each collection is stored as a hive-partitioned Parquet dataset, one directory per month:
+
+    <root>/<collection>/month=2023-11/part-<n>.parquet
+
+A small json file per collection records the high-water mark (the largest value of the collection's time field that
+has been copied, see load_data.TIME_FIELDS). A sync only asks the database for documents at or past that mark (time
+stamps can be shared by documents that arrive later), leaves out the ones already mirrored, and writes the rest as new
+part files, so existing files are never rewritten.
+
+New part files are written hidden, recorded as pending in the watermark file, and only then renamed into place, so a
+sync that is interrupted part way never leaves documents in the mirror that the watermark doesn't cover: the next
+sync finishes the renames if the watermark was written, and deletes the hidden files if it wasn't.
+
+Example usage:
+col_entries, col_treatments, col_profile, col_devicestatus = ld.get_collections(yml_secrets_file)
+mirror.sync_all([col_entries, col_treatments, col_profile, col_devicestatus], mirror_root)
+df_entries = mirror.read_mirror(mirror_root, "entries")
+"""
+from collections import Counter
+import json
+import os
+import time
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from mdb_tools import instrument
+from mdb_tools import load_data as ld
+
+# Profile documents have a free-form "store", so they are mirrored as json text alongside their time stamps
+profile_arrow_schema = pa.schema([
+    ('mills', pa.int64()),
+    ('startDate', pa.string()),
+    ('doc', pa.string()),
+])
+
+
+def _collection_dir(root, name):
+    return os.path.join(root, name)
+
+
+def _watermark_file(root, name):
+    return os.path.join(_collection_dir(root, name), "_watermark.json")
+
+
+def _read_watermark(root, name):
+    """
+    Read the watermark file of a mirrored collection, or None if there isn't one yet
+    """
+    wm_file = _watermark_file(root, name)
+    if not os.path.exists(wm_file):
+        return None
+    with open(wm_file) as file:
+        return json.load(file)
+
+
+def get_watermark(root, name):
+    """
+    Read the high-water mark of a mirrored collection
+
+    Args:
+        root (str): path to the mirror directory
+        name (str): collection name, e.g. "entries"
+
+    Returns: the largest value of the collection's time field copied so far, or None if nothing has been copied
+
+    """
+    watermark = _read_watermark(root, name)
+
+    return None if watermark is None else watermark["value"]
+
+
+def _set_watermark(root, name, field, value, pending=()):
+    """
+    Replace the watermark file in one step (written to a temporary file first), so that it is never left half written
+    """
+    wm_file = _watermark_file(root, name)
+    with open(wm_file + ".tmp", "w") as file:
+        json.dump({"field": field, "value": value, "pending": list(pending), "updated": time.time()}, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(wm_file + ".tmp", wm_file)
+
+
+def _hidden(part_path):
+    """
+    Path of a part file while it is being written (hidden from mirror_dataset() by the "." prefix)
+    """
+    return os.path.join(os.path.dirname(part_path), "." + os.path.basename(part_path))
+
+
+def _recover(root, name):
+    """
+    Clean up after an interrupted sync: finish renaming the part files of a sync whose watermark was written, and
+    delete the hidden part files of one whose watermark wasn't
+    """
+    collection_dir = _collection_dir(root, name)
+    watermark = _read_watermark(root, name)
+    if watermark is not None and len(watermark.get("pending", [])) > 0:
+        for part in watermark["pending"]:
+            part_path = os.path.join(collection_dir, part)
+            if os.path.exists(_hidden(part_path)):
+                os.replace(_hidden(part_path), part_path)
+        _set_watermark(root, name, watermark["field"], watermark["value"])
+
+    for month_dir in os.listdir(collection_dir):
+        if month_dir.startswith("month="):
+            for file_name in os.listdir(os.path.join(collection_dir, month_dir)):
+                if file_name.startswith(".part-"):
+                    os.remove(os.path.join(collection_dir, month_dir, file_name))
+
+
+def _fetch_profile(col, query):
+    """
+    Fetch profile documents into an Arrow table (time stamps plus the whole document as json)
+    """
+    from bson import json_util
+
+    docs = list(col.find(query))
+    return pa.Table.from_pydict({
+        'mills': [int(doc["mills"]) for doc in docs],
+        'startDate': [doc.get("startDate") for doc in docs],
+        'doc': [json_util.dumps(doc) for doc in docs],
+    }, schema=profile_arrow_schema)
+
+
+def _month_keys(table, name):
+    """
+    Get the "YYYY-MM" partition key of each row, from the collection's time field
+    """
+    field = ld.TIME_FIELDS[name]
+    if pa.types.is_string(table.schema.field(field).type):
+        months = pc.utf8_slice_codeunits(table[field], 0, 7)
+    else:
+        as_time = pc.cast(table[field], pa.int64()).cast(pa.timestamp('ms', tz='UTC'))
+        months = pc.strftime(as_time, format='%Y-%m')
+
+    return pc.fill_null(months, "unknown")
+
+
+def _write_partitions(table, root, name):
+    """
+    Write a table of new documents as one new (hidden) part file per month
+
+    Returns: (list) paths of the part files, relative to the collection directory, once they are renamed into place
+
+    """
+    months = _month_keys(table, name)
+    part_name = "part-" + str(time.time_ns()) + ".parquet"
+    parts = []
+    for month in pc.unique(months).to_pylist():
+        month_dir = os.path.join(_collection_dir(root, name), "month=" + month)
+        os.makedirs(month_dir, exist_ok=True)
+        pq.write_table(table.filter(pc.equal(months, month)), _hidden(os.path.join(month_dir, part_name)))
+        parts.append(os.path.join("month=" + month, part_name))
+
+    return parts
+
+
+def _row_keys(table):
+    """
+    A comparable key for each row of a table (its values as json)
+    """
+    return [json.dumps(row, sort_keys=True, default=str) for row in table.to_pylist()]
+
+
+def _drop_mirrored(table, root, name, field, watermark):
+    """
+    Leave out the fetched documents at the watermark that are already in the mirror
+    """
+    at_watermark = pc.equal(table[field], watermark)
+    if not pc.any(at_watermark).as_py():
+        return table
+
+    # Only the mirrored rows with the watermark value are read, from its month
+    expression = ds.field(field) == watermark
+    months = _month_keys(table.filter(at_watermark).slice(0, 1), name).to_pylist()
+    expression = expression & (ds.field("month") == months[0])
+    mirrored = mirror_dataset(root, name).to_table(columns=table.column_names, filter=expression)
+    mirrored_counts = Counter(_row_keys(mirrored.cast(table.schema)))
+
+    keep = []
+    for key, is_boundary in zip(_row_keys(table), at_watermark.to_pylist()):
+        if is_boundary and mirrored_counts[key] > 0:
+            mirrored_counts[key] -= 1
+            keep.append(False)
+        else:
+            keep.append(True)
+
+    return table.filter(pa.array(keep))
+
+
+@instrument.timed
+def sync_collection(col, root, name=None):
+    """
+    Copy any documents newer than the mirror's high-water mark from a collection into the local mirror
+
+    Args:
+        col: A MongoDB collection (or a mongomock stand-in)
+        root (str): path to the mirror directory (created if needed)
+        name (str, Optional): collection name, default is the collection's own name
+
+    Returns: (int) number of documents added to the mirror
+
+    """
+    name = col.name if name is None else name
+    field = ld.TIME_FIELDS[name]
+    os.makedirs(_collection_dir(root, name), exist_ok=True)
+    _recover(root, name)
+
+    # Only ask for documents at or past the high-water mark, and leave out the ones already mirrored
+    watermark = get_watermark(root, name)
+    query = {} if watermark is None else {field: {"$gte": watermark}}
+
+    if name == "profile":
+        table = _fetch_profile(col, query)
+    else:
+        table = ld.find_arrow_table(col, query, ld.get_schema(name))
+
+    if watermark is not None:
+        table = _drop_mirrored(table, root, name, field, watermark)
+
+    if table.num_rows == 0:
+        return 0
+
+    new_watermark = pc.max(table[field]).as_py()
+    new_watermark = watermark if new_watermark is None else new_watermark
+
+    # Record the new part files as pending along with the new watermark, then move them into place
+    parts = _write_partitions(table, root, name)
+    _set_watermark(root, name, field, new_watermark, pending=parts)
+    for part in parts:
+        part_path = os.path.join(_collection_dir(root, name), part)
+        os.replace(_hidden(part_path), part_path)
+    _set_watermark(root, name, field, new_watermark)
+
+    return table.num_rows
+
+
+def sync_all(collections, root):
+    """
+    Bring the mirror of each collection up to date
+
+    Args:
+        collections (list): MongoDB collections, e.g. the tuple returned by load_data.get_collections()
+        root (str): path to the mirror directory
+
+    Returns: (dict) number of documents added, per collection name
+
+    """
+    return {col.name: sync_collection(col, root) for col in collections}
+
+
+def mirror_dataset(root, name):
+    """
+    Open the mirror of a collection as a (lazy) pyarrow dataset
+
+    Args:
+        root (str): path to the mirror directory
+        name (str): collection name, e.g. "entries"
+
+    Returns: pyarrow Dataset, with "month" as a partition field
+
+    """
+    return ds.dataset(_collection_dir(root, name), format="parquet", partitioning="hive",
+                      exclude_invalid_files=True, ignore_prefixes=["_", "."])
+
+
+@instrument.timed
+def read_mirror(root, name, columns=None):
+    """
+    Read the mirror of a collection into a Pandas dataframe
+
+    Args:
+        root (str): path to the mirror directory
+        name (str): collection name, e.g. "entries"
+        columns (list, Optional): columns to read, default is every column of the collection's schema
+
+    Returns: a Pandas dataframe with the same columns as the load_data getters return
+
+    """
+    dataset = mirror_dataset(root, name)
+    if columns is None:
+        columns = [field for field in dataset.schema.names if field != "month"]
+
+    return dataset.to_table(columns=columns).to_pandas()
+
+
+def read_profile_docs(root):
+    """
+    Read the mirrored profile documents, e.g. to build a loop_stats.ProfileTimeline without a database
+
+    Args:
+        root (str): path to the mirror directory
+
+    Returns: (list) profile documents
+
+    """
+    from bson import json_util
+
+    docs = read_mirror(root, "profile", columns=["doc"])["doc"]
+
+    return [json_util.loads(doc) for doc in docs]
@@ -0,0 +1,428 @@
+"""pipeline.py
+A memoized report pipeline over the local Parquet mirror (see mirror.py), with an on-disk result cache.
+
+The report is declared as a set of stages (see default_stages()): each stage names the stages or sources it takes as
+inputs, its parameters, and whether it is computed day by day. Every result is stored in the cache under a hash of
+what it was computed from, so running the pipeline again only recomputes what changed:
+
+- A "by day" stage (e.g. daily CGM statistics) hashes the input data of each local day. Only the days whose hash
+  changed since the last run (e.g. today, after a sync) are recomputed; every other day is read back from the cache.
+- Any other stage (e.g. the weekly rollup) is recomputed only when the hash of one of its inputs changes.
+
+The cache is bounded in size: when it grows past max_cache_bytes, the least recently used results are deleted.
+
+Example usage:
+mirror.sync_all(ld.get_collections(yml_secrets_file), mirror_root)
+report = pipeline.Pipeline(mirror_root, cache_dir, time_zone='US/Eastern')
+df_daily = report.run("daily_report", '2023-01-01', '2024-01-01')
+df_weekly = report.run("weekly_report", '2023-01-01', '2024-01-01')
+"""
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from mdb_tools import loop_stats as oop
+from mdb_tools import mirror
+from mdb_tools import query
+from mdb_tools.schemas import compact_table
+
+# A pipeline stage. function is called with the inputs' results (in order), then the params. A by_day stage also gets
+# start, end (naive local midnights) and time_zone, and returns a dataframe indexed by (naive local) date. Each of
+# its days also depends on the previous lookback_days days of input (e.g. a temp basal running over midnight).
+Stage = namedtuple("Stage", ["function", "inputs", "params", "by_day", "lookback_days"],
+                   defaults=[{}, False, 0])
+
+# Inputs that are read from the mirror rather than computed by a stage
+SOURCES = ["entries", "treatments", "profile"]
+
+# Columns of each source that are hashed to tell whether a day's data changed
+_HASH_COLUMNS = {
+    "entries": ["date", "sgv", "device"],
+    "treatments": ["time", "eventType", "insulin", "rate", "absolute", "duration"],
+}
+
+_DAY_NS = 86400 * 1_000_000_000
+
+
+def _hash(*parts):
+    """
+    Hash anything json can write (with str() for the rest) into a short hex key
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+
+class ResultCache:
+    """
+    Dataframes stored as Parquet files in a directory, keyed by content hash, with least recently used eviction once
+    the directory grows past max_bytes. Reading a result marks it as used (by touching its file).
+
+    Args:
+        cache_dir (str): directory for the cache (created if needed)
+        max_bytes (int, Optional): size the cache is trimmed to after every write, default is 500 MB
+
+    """
+
+    def __init__(self, cache_dir, max_bytes=500_000_000):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".parquet")
+
+    def get(self, key):
+        """
+        Returns: the dataframe stored under a key, or None if there is none
+        """
+        path = self._path(key)
+        try:
+            df = pd.read_parquet(path)
+        except (FileNotFoundError, OSError):
+            return None
+        os.utime(path)
+
+        return df
+
+    def put(self, key, df):
+        """
+        Store a dataframe under a key, then evict the least recently used results if the cache is too big
+        """
+        path = self._path(key)
+        df.to_parquet(path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """
+        Delete the least recently used results until the cache fits in max_bytes (never deleting the keep file)
+
+        Returns: (int) number of results deleted
+
+        """
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".parquet"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+
+        n_deleted = 0
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+            n_deleted += 1
+
+        return n_deleted
+
+    def size_bytes(self):
+        """
+        Returns: (int) total size of the stored results
+        """
+        return sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.name.endswith(".parquet"))
+
+    def latest(self, name):
+        """
+        Returns: (str) key of the last result stored for a by_day stage (see Pipeline), or None
+        """
+        pointers = self._pointers()
+
+        return pointers.get(name)
+
+    def set_latest(self, name, key):
+        pointers = self._pointers()
+        pointers[name] = key
+        with open(os.path.join(self.cache_dir, "_latest.json"), "w") as file:
+            json.dump(pointers, file)
+
+    def _pointers(self):
+        path = os.path.join(self.cache_dir, "_latest.json")
+        if not os.path.exists(path):
+            return {}
+        with open(path) as file:
+            return json.load(file)
+
+
+# ##### Default stages #####
+
+def cgm_daily(df_entries, start, end, time_zone, min_target=70, max_target=180):
+    """
+    Stage: daily CGM statistics, see loop_stats.daily_cgm_stats()
+    """
+    df_cgm_daily = oop.daily_cgm_stats(df_entries["time"], df_entries["sgv"], min_target, max_target, time_zone)
+
+    return df_cgm_daily.set_index("time").drop(columns="yearday").rename_axis("date")
+
+
+def insulin_daily(df_treatments, timeline, start, end, time_zone, req_profile="Default"):
+    """
+    Stage: daily insulin totals, see loop_stats.daily_insulin_totals()
+    """
+    return oop.daily_insulin_totals(df_treatments, timeline, start, end, time_zone, req_profile)
+
+
+def daily_report(df_cgm_daily, df_insulin_daily):
+    """
+    Stage: daily CGM statistics and insulin totals side by side
+    """
+    return df_cgm_daily.join(df_insulin_daily, how='outer')
+
+
+def weekly_report(df_daily):
+    """
+    Stage: weekly (Monday to Sunday) rollup of the daily report. CGM statistics are weighted by each day's number of
+    readings, and insulin totals are summed.
+
+    Returns: pandas dataframe indexed by the date of each week's Monday, with days (days with data), count, mean, min,
+        max, pct_above, pct_below, pct_inrange and the summed insulin columns
+
+    """
+    weeks = df_daily.index - pd.to_timedelta(df_daily.index.dayofweek, unit='D')
+    weights = df_daily["count"].fillna(0)
+    grouped_weights = weights.groupby(weeks).sum()
+
+    df_weekly = pd.DataFrame({"days": df_daily["count"].groupby(weeks).count(), "count": grouped_weights})
+    for column in ["mean", "pct_above", "pct_below", "pct_inrange"]:
+        df_weekly[column] = (df_daily[column] * weights).groupby(weeks).sum() / grouped_weights
+    df_weekly["min"] = df_daily["min"].groupby(weeks).min()
+    df_weekly["max"] = df_daily["max"].groupby(weeks).max()
+    for column in ["basal", "basal_adjust", "basal_total", "bolus", "insulin_sum"]:
+        if column in df_daily.columns:
+            df_weekly[column] = df_daily[column].groupby(weeks).sum(min_count=1)
+
+    return df_weekly.rename_axis("date")
+
+
+def default_stages(min_target=70, max_target=180, req_profile="Default"):
+    """
+    The stages of the standard report: cgm_daily and insulin_daily (by day), daily_report and weekly_report
+
+    Returns: (dict) Stage per stage name
+
+    """
+    return {
+        "cgm_daily": Stage(cgm_daily, ["entries"], {"min_target": min_target, "max_target": max_target}, True),
+        "insulin_daily": Stage(insulin_daily, ["treatments", "profile"], {"req_profile": req_profile}, True, 1),
+        "daily_report": Stage(daily_report, ["cgm_daily", "insulin_daily"]),
+        "weekly_report": Stage(weekly_report, ["daily_report"]),
+    }
+
+
+class Pipeline:
+    """
+    Runs the stages of a report over the mirror, reusing cached results wherever their inputs haven't changed
+
+    Args:
+        mirror_root (str): path to the mirror directory (see mirror.py)
+        cache_dir (str): directory for the result cache
+        stages (dict, Optional): Stage per stage name, default is default_stages()
+        time_zone (str, Optional): time zone that defines the days, default is "UTC"
+        dedupe (bool, Optional): drop CGM readings uploaded by more than one source (see loop_stats.dedupe_entries())
+            before any stage sees them, default is True
+        max_cache_bytes (int, Optional): size limit of the result cache, default is 500 MB
+
+    """
+
+    def __init__(self, mirror_root, cache_dir, stages=None, time_zone='UTC', dedupe=True,
+                 max_cache_bytes=500_000_000):
+        self.mirror_root = mirror_root
+        self.stages = default_stages() if stages is None else stages
+        self.time_zone = time_zone
+        self.dedupe = dedupe
+        self.cache = ResultCache(cache_dir, max_cache_bytes)
+
+        # Number of days recomputed by each by_day stage in the last run (days without a result aren't counted)
+        self.recomputed = {}
+
+    def run(self, target, start, end):
+        """
+        Get the result of a stage between two days
+
+        Args:
+            target (str): stage name, e.g. "weekly_report"
+            start (datetime-like): first day (local to time_zone)
+            end (datetime-like): end of the period (exclusive, local to time_zone)
+
+        Returns: pandas dataframe
+
+        """
+        if target not in self.stages:
+            raise Exception("There is no stage " + target + ", must be one of: " + ', '.join(self.stages.keys()))
+
+        first_day = pd.Timestamp(start).tz_localize(None).normalize().value // _DAY_NS
+        end_day = pd.Timestamp(end).tz_localize(None).normalize().value // _DAY_NS
+        lookback = max([stage.lookback_days for stage in self.stages.values()] + [0])
+
+        # Results of this run, by stage or source name: (key, result, hash of each day for sources)
+        self._run_results = {}
+        self._window = (first_day, end_day, first_day - lookback)
+        self.recomputed = {}
+
+        return self._result(target)[1]
+
+    # ##### Sources #####
+
+    def _read_mirror(self, name, columns=None):
+        """
+        Read a mirrored collection over the run's days (plus the look-back), padded by a day either side for time
+        zones, as an Arrow table
+        """
+        first_day, end_day, read_from = self._window
+        if not os.path.isdir(os.path.join(self.mirror_root, name)):
+            return None
+        start = pd.Timestamp((read_from - 1) * _DAY_NS, tz='UTC')
+        end = pd.Timestamp((end_day + 1) * _DAY_NS, tz='UTC')
+        dataset = mirror.mirror_dataset(self.mirror_root, name)
+
+        return dataset.to_table(columns=columns, filter=query.time_filter(name, start, end))
+
+    def _source(self, name):
+        """
+        Load a source for the run: a dataframe with a "day" column (local day key) and the hash of each day's data,
+        or for "profile", a ProfileTimeline and the hash of its documents
+        """
+        first_day, end_day, read_from = self._window
+
+        if name == "profile":
+            docs = mirror.read_profile_docs(self.mirror_root)
+            return _hash(sorted(int(doc["mills"]) for doc in docs)), oop.ProfileTimeline(docs), None
+
+        if name == "entries":
+            table = self._read_mirror("entries", ["date", "sgv", "device"])
+            df = pd.DataFrame(columns=["date", "sgv", "device"]) if table is None else table.to_pandas()
+            if self.dedupe and len(df) > 0:
+                df = oop.dedupe_entries(df)
+            df["time"] = pd.to_datetime(df["date"].astype('int64'), unit='ms', utc=True)
+        elif name == "treatments":
+            table = self._read_mirror("treatments")
+            if table is None:
+                df = pd.DataFrame({column: pd.Series(dtype='float64') for column in _HASH_COLUMNS[name]})
+                df["time"] = pd.to_datetime(df["time"], utc=True)
+            else:
+                df = compact_table(table.drop_columns(["month"]), "treatments").to_pandas()
+        else:
+            raise Exception("There is no source " + name + ", must be one of: " + ', '.join(SOURCES))
+
+        df["day"] = oop.get_yeardays(df["time"], as_int=True, time_zone=self.time_zone).values
+        df = df[(df["day"] >= read_from) & (df["day"] < end_day)].sort_values("time")
+
+        # Hash of each day: the (order independent, wrapping) sum of its row hashes. Sorted by time, the rows of
+        # each day are contiguous.
+        day_hashes = {}
+        if len(df) > 0:
+            row_hashes = pd.util.hash_pandas_object(df[_HASH_COLUMNS[name]], index=False).to_numpy()
+            days, day_starts = np.unique(df["day"].to_numpy(), return_index=True)
+            day_hashes = dict(zip(days.tolist(), np.add.reduceat(row_hashes, day_starts).tolist()))
+
+        return _hash(sorted(day_hashes.items())), df, day_hashes
+
+    # ##### Stages #####
+
+    def _result(self, name):
+        """
+        Get the (key, result, day hashes) of a stage or source, computing it (and its inputs) if needed
+        """
+        if name in self._run_results:
+            return self._run_results[name]
+
+        if name in SOURCES:
+            result = self._source(name)
+        elif name in self.stages:
+            stage = self.stages[name]
+            inputs = [self._result(input_name) for input_name in stage.inputs]
+            result = self._run_by_day(name, stage, inputs) if stage.by_day else self._run_stage(name, stage, inputs)
+        else:
+            raise Exception("Unknown stage or source: " + name)
+
+        self._run_results[name] = result
+
+        return result
+
+    def _run_stage(self, name, stage, inputs):
+        """
+        Run a stage on its whole inputs, or read its result from the cache if they haven't changed
+        """
+        key = _hash(name, stage.params, self.time_zone, [input_key for input_key, _, _ in inputs])
+        df_result = self.cache.get(key)
+        if df_result is None:
+            df_result = stage.function(*[result for _, result, _ in inputs], **stage.params)
+            self.cache.put(key, df_result)
+
+        return key, df_result, None
+
+    def _run_by_day(self, name, stage, inputs):
+        """
+        Run a by_day stage, only on the days whose input data (or look-back days) changed since the last run
+        """
+        first_day, end_day, _ = self._window
+        stage_id = _hash(name, stage.params, self.time_zone, stage.function.__name__)
+
+        # ##### Key of each day: the stage, plus the hash of its input data on the day and the look-back days #####
+        day_keys = {}
+        for day in range(first_day, end_day):
+            input_hashes = [input_key if day_hashes is None else
+                            [day_hashes.get(previous, 0) for previous in range(day - stage.lookback_days, day + 1)]
+                            for input_key, _, day_hashes in inputs]
+            day_keys[day] = _hash(stage_id, input_hashes)
+
+        # ##### Reuse the days that are unchanged since the last run #####
+        latest_key = self.cache.latest(stage_id)
+        df_previous = None if latest_key is None else self.cache.get(latest_key)
+        if df_previous is not None:
+            previous_days = df_previous.index.values.astype('datetime64[D]').astype('int64')
+            in_window = (previous_days >= first_day) & (previous_days < end_day)
+            still_valid = in_window & (df_previous["_day_key"].to_numpy() ==
+                                       np.array([day_keys.get(day) for day in previous_days], dtype=object))
+            # Days outside this run are kept for later runs
+            df_kept = df_previous[still_valid | ~in_window]
+            done_days = set(previous_days[still_valid].tolist())
+        else:
+            df_kept = None
+            done_days = set()
+
+        # ##### Recompute each run of consecutive changed days #####
+        changed = np.array([day for day in range(first_day, end_day) if day not in done_days], dtype='int64')
+        self.recomputed[name] = 0
+        new_results = []
+        if len(changed) > 0:
+            run_starts = np.flatnonzero(np.diff(changed, prepend=changed[0] - 2) != 1)
+            for run_first, run_last in zip(changed[run_starts], np.append(changed[run_starts[1:] - 1], changed[-1])):
+                run_inputs = [result if day_hashes is None else
+                              result[(result["day"] >= run_first - stage.lookback_days) & (result["day"] <= run_last)]
+                              for _, result, day_hashes in inputs]
+                # Every requested day is run, whether or not it has input rows (e.g. scheduled basal is delivered
+                # on days without treatments). The stage decides which days it has a result for.
+                df_run = stage.function(*run_inputs, pd.Timestamp(run_first * _DAY_NS),
+                                        pd.Timestamp((run_last + 1) * _DAY_NS), self.time_zone, **stage.params)
+                run_days = df_run.index.values.astype('datetime64[D]').astype('int64')
+                in_run = (run_days >= run_first) & (run_days <= run_last)
+                if not in_run.any():
+                    # Nothing to store (e.g. no CGM readings), these days are run again next time
+                    continue
+                df_run = df_run[in_run].copy()
+                df_run["_day_key"] = [day_keys[day] for day in run_days[in_run]]
+                self.recomputed[name] += len(df_run)
+                new_results.append(df_run)
+
+        # ##### Store every day's result under the hash of all the day keys #####
+        if len(new_results) > 0 or df_kept is None:
+            parts = ([] if df_kept is None else [df_kept]) + new_results
+            df_all = pd.concat(parts).sort_index() if len(parts) > 0 else pd.DataFrame(columns=["_day_key"])
+            df_all = df_all[~df_all.index.duplicated(keep='last')]
+            all_key = _hash(stage_id, df_all["_day_key"].tolist())
+            self.cache.put(all_key, df_all)
+            self.cache.set_latest(stage_id, all_key)
+        else:
+            df_all = df_kept
+
+        window_days = df_all.index.values.astype('datetime64[D]').astype('int64')
+        df_window = df_all[(window_days >= first_day) & (window_days < end_day)].drop(columns="_day_key")
+
+        return _hash(name, [day_keys[day] for day in range(first_day, end_day)]), df_window, None
@@ -0,0 +1,265 @@
+"""query.py
+Run filtered, grouped queries over the local Parquet mirror of the Loop collections (see mirror.py) without loading
+the whole history into pandas.
+
+Queries scan the mirror one record batch at a time. Time filters are pushed down into the Parquet scan, and the month
+partitions outside the requested period are never opened, so memory use depends on the batch size and the size of
+the result (one row per day, week or pod), not on how many years of data there are.
+
+Example usage:
+mirror.sync_all(ld.get_collections(yml_secrets_file), mirror_root)
+df_weekly = query.cgm_stats(mirror_root, by="week", start='2021-01-01', time_zone='US/Eastern')
+df_pods = query.pod_stats(mirror_root)
+"""
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+from mdb_tools import live
+from mdb_tools import load_data as ld
+from mdb_tools import loop_stats as oop
+from mdb_tools import mirror
+
+
+def time_filter(name, start=None, end=None):
+    """
+    Build a dataset filter that selects the documents of a mirrored collection between two times: a filter on the
+    collection's time field (see load_data.TIME_FIELDS), plus one on the month partitions so that only the months
+    that overlap the period are read
+
+    Args:
+        name (str): collection name, e.g. "entries"
+        start (datetime-like, Optional): only select documents at or after this time (naive times are UTC)
+        end (datetime-like, Optional): only select documents before this time (naive times are UTC)
+
+    Returns: pyarrow dataset Expression, or None if there is no start or end
+
+    """
+    field = ld.TIME_FIELDS[name]
+    expression = None
+    if start is not None:
+        start_utc = pd.Timestamp(start)
+        start_utc = start_utc.tz_localize('UTC') if start_utc.tz is None else start_utc.tz_convert('UTC')
+        expression = (ds.field(field) >= ld._time_bound(field, start_utc)) & \
+                     (ds.field("month") >= start_utc.strftime('%Y-%m'))
+    if end is not None:
+        end_utc = pd.Timestamp(end)
+        end_utc = end_utc.tz_localize('UTC') if end_utc.tz is None else end_utc.tz_convert('UTC')
+        end_expression = (ds.field(field) < ld._time_bound(field, end_utc)) & \
+                         (ds.field("month") <= end_utc.strftime('%Y-%m'))
+        expression = end_expression if expression is None else expression & end_expression
+
+    return expression
+
+
+def scan(root, name, columns=None, start=None, end=None, filter=None, batch_size=100_000):
+    """
+    Read a mirrored collection one batch at a time
+
+    Example usage:
+    for batch in query.scan(mirror_root, "entries", columns=["date", "sgv"], start='2022-01-01'):
+        df_batch = batch.to_pandas()
+
+    Args:
+        root (str): path to the mirror directory
+        name (str): collection name, e.g. "entries"
+        columns (list or dict, Optional): columns to read, or a dict of output names to dataset expressions (e.g.
+            {"override": ds.field("pump", "reservoir_display_override")} for a nested field). Default is all of them.
+        start (datetime-like, Optional): only read documents at or after this time (naive times are UTC)
+        end (datetime-like, Optional): only read documents before this time (naive times are UTC)
+        filter (pyarrow dataset Expression, Optional): any other filter on the documents
+        batch_size (int, Optional): largest number of rows per batch, default is 100000
+
+    Yields: pyarrow RecordBatch
+
+    """
+    expression = time_filter(name, start, end)
+    if filter is not None:
+        expression = filter if expression is None else expression & filter
+
+    dataset = mirror.mirror_dataset(root, name)
+    yield from dataset.to_batches(columns=columns, filter=expression, batch_size=batch_size)
+
+
+def _entry_times(batch):
+    """
+    Get the (UTC) reading times of a batch of entries, from the numeric "date" field
+    """
+    return pd.DatetimeIndex(pd.to_datetime(batch.column("date").to_numpy(zero_copy_only=False), unit='ms', utc=True))
+
+
+def cgm_stats(root, by="day", start=None, end=None, time_zone='UTC', min_target=70, max_target=180,
+              batch_size=100_000):
+    """
+    Daily or weekly CGM statistics over the mirrored entries, computed from running totals one batch at a time
+
+    Args:
+        root (str): path to the mirror directory
+        by (str, Optional): "day" or "week" (Monday to Sunday), default is "day"
+        start (datetime-like, Optional): only use readings at or after this time (naive times are UTC)
+        end (datetime-like, Optional): only use readings before this time (naive times are UTC)
+        time_zone (str, Optional): time zone that defines the days, default is "UTC"
+        min_target (num, Optional): minimum blood glucose target in mg/dL, default is 70
+        max_target (num, Optional): maximum blood glucose target in mg/dL, default is 180
+        batch_size (int, Optional): largest number of readings held in memory at once, default is 100000
+
+    Returns: pandas dataframe with the live.DailyCGMAccumulator.daily_stats() columns (count, mean, std, min, max,
+        yearday, time, pct_above, pct_below and pct_inrange), one row per day or week
+
+    """
+    if by not in ["day", "week"]:
+        raise Exception("by must be \"day\" or \"week\", not " + str(by))
+
+    accumulator = live.DailyCGMAccumulator(min_target, max_target, time_zone)
+    for batch in scan(root, "entries", ["date", "sgv"], start, end, batch_size=batch_size):
+        accumulator.update(_entry_times(batch), batch.column("sgv").to_numpy(zero_copy_only=False))
+
+    return accumulator.daily_stats() if by == "day" else accumulator.weekly_stats()
+
+
+def bg_histogram(root, bins=np.arange(40, 410, 10), by="day", start=None, end=None, time_zone='UTC',
+                 batch_size=100_000):
+    """
+    Histogram of the mirrored CGM readings per day (or hour of the day), built one batch at a time, see
+    loop_stats.bg_histogram()
+
+    Args:
+        root (str): path to the mirror directory
+        bins (array-like, Optional): bin edges in mg/dL, default is 40 to 400 in steps of 10
+        by (str, Optional): "day" or "hour", default is "day"
+        start (datetime-like, Optional): only use readings at or after this time (naive times are UTC)
+        end (datetime-like, Optional): only use readings before this time (naive times are UTC)
+        time_zone (str, Optional): time zone that defines the days and hours, default is "UTC"
+        batch_size (int, Optional): largest number of readings held in memory at once, default is 100000
+
+    Returns: pandas dataframe of counts, indexed by date (or hour), with the left edge of each bin as the columns
+
+    """
+    histogram = None
+    for batch in scan(root, "entries", ["date", "sgv"], start, end, batch_size=batch_size):
+        batch_histogram = oop.bg_histogram(_entry_times(batch), batch.column("sgv").to_numpy(zero_copy_only=False),
+                                           bins=bins, by=by, time_zone=time_zone)
+        histogram = batch_histogram if histogram is None else oop.merge_bg_histograms(histogram, batch_histogram)
+
+    return histogram
+
+
+def pod_changes(root, start=None, end=None, pairing_flag='Finish Pairing', batch_size=100_000):
+    """
+    Pod change times in the mirrored device statuses, see loop_stats.get_pod_changes(). Only the device statuses
+    that mark a pod change are read into memory.
+
+    Args:
+        root (str): path to the mirror directory
+        start (datetime-like, Optional): only look at device statuses at or after this time (naive times are UTC)
+        end (datetime-like, Optional): only look at device statuses before this time (naive times are UTC)
+        pairing_flag (str, Optional): reservoir display override that marks a pod change, default is 'Finish Pairing'
+        batch_size (int, Optional): largest number of rows per batch, default is 100000
+
+    Returns: (DatetimeIndex) sorted pod change times (UTC)
+
+    """
+    override = ds.field("pump", "reservoir_display_override")
+    change_times = [batch.column("created_at").to_pandas()
+                    for batch in scan(root, "devicestatus", {"created_at": ds.field("created_at")}, start, end,
+                                      filter=override == pairing_flag, batch_size=batch_size)]
+    if len(change_times) == 0:
+        return pd.DatetimeIndex([], tz='UTC')
+
+    return pd.DatetimeIndex(pd.to_datetime(pd.concat(change_times), utc=True, format='ISO8601')).sort_values()
+
+
+def pod_stats(root, start=None, end=None, min_target=70, max_target=180, wrap_hours=72, batch_size=100_000):
+    """
+    CGM statistics per pod session over the mirrored entries and device statuses
+
+    Args:
+        root (str): path to the mirror directory
+        start (datetime-like, Optional): only use data at or after this time (naive times are UTC)
+        end (datetime-like, Optional): only use data before this time (naive times are UTC)
+        min_target (num, Optional): minimum blood glucose target in mg/dL, default is 70
+        max_target (num, Optional): maximum blood glucose target in mg/dL, default is 180
+        wrap_hours (num, Optional): nominal pod life in hours, see loop_stats.tag_pod_sessions(), default is 72
+        batch_size (int, Optional): largest number of readings held in memory at once, default is 100000
+
+    Returns: pandas dataframe indexed by pod_session, with pod_times (the pod change), count, mean, min, max,
+        pct_above, pct_below, pct_inrange and hours (time from the pod change to its last reading). Readings before
+        the first pod change are left out.
+
+    """
+    # Pod changes before the start still tell which pod the first readings came from
+    change_times = pod_changes(root, None, end, batch_size=batch_size)
+
+    partials = []
+    for batch in scan(root, "entries", ["date", "sgv"], start, end, batch_size=batch_size):
+        df_pods = oop.tag_pod_sessions(_entry_times(batch), change_times, wrap_hours)
+        bg = batch.column("sgv").to_numpy(zero_copy_only=False).astype('float64')
+        df_batch = pd.DataFrame({
+            "pod_session": df_pods["pod_session"].values,
+            "n": 1,
+            "count": ~np.isnan(bg),
+            "sum": np.nan_to_num(bg),
+            "min": bg,
+            "max": bg,
+            "above": bg > max_target,
+            "below": bg <= min_target,
+            "inrange": (bg > min_target) & (bg <= max_target),
+            "hours": df_pods["pod_age_hours"].values,
+        })
+        df_batch = df_batch[df_batch["pod_session"] >= 0]
+        partials.append(df_batch.groupby("pod_session").agg({"n": "sum", "count": "sum", "sum": "sum", "min": "min",
+                                                             "max": "max", "above": "sum", "below": "sum",
+                                                             "inrange": "sum", "hours": "max"}))
+
+    if len(partials) == 0:
+        return pd.DataFrame(columns=["pod_times", "count", "mean", "min", "max", "pct_above", "pct_below",
+                                     "pct_inrange", "hours"]).rename_axis("pod_session")
+
+    # A pod session can span batches, so fold the per-batch partials together
+    df_totals = pd.concat(partials).groupby(level=0).agg({"n": "sum", "count": "sum", "sum": "sum", "min": "min",
+                                                          "max": "max", "above": "sum", "below": "sum",
+                                                          "inrange": "sum", "hours": "max"})
+
+    df_pod_stats = pd.DataFrame({
+        "pod_times": change_times[df_totals.index],
+        "count": df_totals["count"],
+        "mean": df_totals["sum"] / df_totals["count"],
+        "min": df_totals["min"],
+        "max": df_totals["max"],
+        "pct_above": df_totals["above"] / df_totals["n"] * 100,
+        "pct_below": df_totals["below"] / df_totals["n"] * 100,
+        "pct_inrange": df_totals["inrange"] / df_totals["n"] * 100,
+        "hours": df_totals["hours"],
+    }, index=df_totals.index)
+
+    return df_pod_stats
+
+
+def sql(root, query_text, collections=("entries", "treatments", "devicestatus")):
+    """
+    Run a SQL query over the mirrored collections with DuckDB (optional, "pip install duckdb"). Each collection is a
+    view with its own name, read straight from the Parquet files, so DuckDB can push filters and column selections
+    down into the scan.
+
+    Example usage:
+    df_weekly = query.sql(mirror_root, "SELECT date_trunc('week', to_timestamp(date / 1000)) AS week, "
+                                       "avg(sgv) AS mean FROM entries WHERE month >= '2022-01' GROUP BY week")
+
+    Args:
+        root (str): path to the mirror directory
+        query_text (str): SQL query
+        collections (tuple, Optional): collections to make available as views, default is entries, treatments and
+            devicestatus
+
+    Returns: pandas dataframe with the query result
+
+    """
+    try:
+        import duckdb
+    except ImportError:
+        raise Exception("query.sql() needs DuckDB, install it with: pip install duckdb")
+
+    with duckdb.connect() as connection:
+        for name in collections:
+            connection.register(name, mirror.mirror_dataset(root, name))
+        return connection.execute(query_text).df()
@@ -1,23 +1,40 @@
-from pymongoarrow.api import Schema
 # from pymongoarrow.types import list_
 import pyarrow as pa
+import pyarrow.compute as pc
 import numpy as np
+import pandas as pd
 
+# ISO 8601 time strings, which compact_table() decodes into timestamps
+TIME_STRING_FIELDS = ['dateString', 'created_at', 'timestamp']
 
-def mdb_schemas():
+# Low-cardinality strings, which compact_table() dictionary-encodes (they become categoricals in pandas)
+DICTIONARY_FIELDS = ['device', 'eventType', 'foodType', 'temp']
+
+
+def mdb_schemas(compact=False):
     """
     Example usage:
     entries_schema, treatments_schema, devicestatus_schema = mdb_schemas()
 
+    Args:
+        compact (bool, Optional): leave out fields that compact_table() can rebuild from others (the entries
+            dateString, which duplicates date). Default is False.
+
     Returns: a tuple containing entries, treatments, and device status schemas
 
     """
-    entries_schema = Schema({
+    # Imported here, so that compact_table() can be used without pymongoarrow
+    from pymongoarrow.api import Schema
+
+    entries_fields = {
         'sgv': float,
         'dateString': str,
         'date': int,
         'device': str,
-    })
+    }
+    if compact:
+        del entries_fields['dateString']
+    entries_schema = Schema(entries_fields)
 
     treatments_schema = Schema({
         'duration': float,
@@ -40,7 +57,8 @@ def mdb_schemas():
         'created_at': str,
         'override': {'active': bool},
         'loop': {
-            'predicted': {'values': pa.list_(pa.float64())},
+            'predicted': {'startDate': str,
+                          'values': pa.list_(pa.float64())},
             'enacted': {'duration': float,
                         'rate': float,
                         'bolusVolume': float,
@@ -58,3 +76,58 @@ def mdb_schemas():
     return entries_schema, treatments_schema, devicestatus_schema
 
 
+def _decode_time_strings(column):
+    """
+    Decode ISO 8601 time strings into UTC timestamps (microseconds). Arrow parses the usual Nightscout forms ("Z" or a
+    numeric offset) without Python; anything else (e.g. strings without an offset, which are taken to be UTC) falls
+    back to pandas.
+    """
+    try:
+        return pc.cast(column, pa.timestamp('us', tz='UTC'))
+    except pa.ArrowInvalid:
+        times = pd.to_datetime(column.to_pandas(), utc=True, format='ISO8601', errors='coerce')
+        return pa.array(times.astype('datetime64[us, UTC]'), type=pa.timestamp('us', tz='UTC'))
+
+
+def compact_table(table, collection_name):
+    """
+    Shrink a table loaded with one of the mdb_schemas() schemas and decode its times, so that nothing has to be parsed
+    in pandas: time strings become UTC timestamps, sgv becomes float32, and low-cardinality strings (device,
+    eventType, ...) are dictionary-encoded. A "time" column (UTC, nanoseconds) is added from the numeric date of
+    entries, or from the timestamp (falling back to created_at) of treatments and device statuses.
+
+    Example usage:
+    table = compact_table(ld.find_arrow_table(col_entries, {}, ld.get_schema("entries", compact=True)), "entries")
+    df_entries = table.to_pandas().set_index("time")
+
+    Args:
+        table (pyarrow Table): documents of the collection
+        collection_name (str): "entries", "treatments" or "devicestatus"
+
+    Returns: pyarrow Table
+
+    """
+    columns = {}
+    for name in table.column_names:
+        column = table[name]
+        if name in TIME_STRING_FIELDS and pa.types.is_string(column.type):
+            column = _decode_time_strings(column)
+        elif name == 'sgv':
+            column = pc.cast(column, pa.float32())
+        elif name in DICTIONARY_FIELDS and pa.types.is_string(column.type):
+            column = column.dictionary_encode()
+        columns[name] = column
+
+    # ##### Time of each document #####
+    if collection_name == "entries" and 'date' in columns:
+        time = pc.cast(columns['date'], pa.int64()).cast(pa.timestamp('ms', tz='UTC'))
+    elif 'timestamp' in columns and 'created_at' in columns:
+        time = pc.coalesce(columns['timestamp'], columns['created_at'])
+    elif 'created_at' in columns:
+        time = columns['created_at']
+    else:
+        raise Exception("Can't find the time of the " + collection_name + " documents, the table needs a " +
+                        ("date" if collection_name == "entries" else "created_at") + " column")
+    columns['time'] = pc.cast(time, pa.timestamp('ns', tz='UTC'))
+
+    return pa.table(columns)
@@ -2,30 +2,34 @@
 
 This module contains functions for plotting both blood glucose and insulin data.
 
+matplotlib and seaborn are imported by the plotting functions, so the downsampling functions can be used (e.g. to
+prepare data for another plotting library) without them.
 """
-import sys
-
-sys.path.append("../")
-
-import matplotlib.pyplot as plt
-import seaborn as sns
+import numpy as np
+import pandas as pd
 
 from mdb_tools import loop_stats as oop
 
 
-def daily_tir(time_vec, cgm_data, min_target=70, max_target=180):
+def daily_tir(time_vec=None, cgm_data=None, min_target=70, max_target=180, df_cgm_daily=None):
     """
     Daily time in range, presented as a bar plot.
     Plot a bar chart of daily time in range from CGM data
 
     Example usage:
-    fig, ax = daily_bars(df_cgm_daily)
+    fig, ax = daily_tir(df_entries["time"], df_entries["sgv"])
+
+    # Or from daily statistics computed already (e.g. by live.DailyCGMAccumulator or query.cgm_stats())
+    fig, ax = daily_tir(df_cgm_daily=df_cgm_daily)
 
     Args
-        time_vec (array-like): array or list or series of times
-        cgm_data (array-like): array or list or series of CGM values at each point in time_vec. Must be same length as time_vec
+        time_vec (array-like, Optional): array or list or series of times. Not needed with df_cgm_daily.
+        cgm_data (array-like, Optional): array or list or series of CGM values at each point in time_vec. Must be same
+            length as time_vec. Not needed with df_cgm_daily.
         min_target (num, Optional): minimum blood glucose target in mg/dL, default is 70
         max_target (num, Optional): maximum blood glucose target in mg/dL, default is 180
+        df_cgm_daily (dataframe, Optional): daily statistics with time, pct_below, pct_inrange and pct_above columns
+            (see loop_stats.daily_cgm_stats()), instead of computing them from time_vec and cgm_data
 
     Returns:
         A 2-element tuple
@@ -34,8 +38,14 @@ def daily_tir(time_vec, cgm_data, min_target=70, max_target=180):
         - **ax** (matplotlib axis object)
     """
 
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     # Load daily CGM stats
-    df_cgm_daily = oop.daily_cgm_stats(time_vec, cgm_data)
+    if df_cgm_daily is None:
+        if time_vec is None or cgm_data is None:
+            raise Exception("daily_tir needs either time_vec and cgm_data, or df_cgm_daily")
+        df_cgm_daily = oop.daily_cgm_stats(time_vec, cgm_data, min_target, max_target)
 
     # Generate bar plot
     fig, ax = plt.subplots(1, 1, figsize=(8, 4))
@@ -59,3 +69,150 @@ def daily_tir(time_vec, cgm_data, min_target=70, max_target=180):
     ax.set_title("Target range: " + str(min_target) + " - " + str(max_target) + " mg/dL")
 
     return fig, ax
+
+
+def _plot_coordinates(time_vec, values):
+    """
+    Convert times and values into float arrays (times as nanoseconds), dropping points with a missing value
+    """
+    times = pd.DatetimeIndex(time_vec)
+    values = np.asarray(values, dtype='float64')
+    keep = ~np.isnan(values) & ~times.isna()
+
+    return times.asi8[keep].astype('float64'), values[keep], np.flatnonzero(keep)
+
+
+def downsample_minmax(time_vec, values, n_buckets=2000):
+    """
+    Downsample a time series by keeping the lowest and highest point of each of n_buckets equal time buckets (e.g.
+    one per pixel column), so that every high and low is still drawn
+
+    Args:
+        time_vec (array-like): array or list or series of times
+        values (array-like): value at each time (e.g. CGM readings). Missing values are dropped.
+        n_buckets (int, Optional): number of time buckets, default is 2000 (at most 4000 points are kept)
+
+    Returns: (numpy array) sorted positions of the kept points in time_vec
+
+    """
+    x, y, positions = _plot_coordinates(time_vec, values)
+    if len(x) <= 2 * n_buckets:
+        return positions[np.argsort(x, kind='stable')]
+
+    buckets = np.minimum(((x - x.min()) / (x.max() - x.min()) * n_buckets).astype('int64'), n_buckets - 1)
+
+    # Sort by bucket, then value: the first and last point of each bucket are its minimum and maximum
+    order = np.lexsort((y, buckets))
+    bucket_starts = np.flatnonzero(np.diff(buckets[order], prepend=-1) != 0)
+    bucket_ends = np.append(bucket_starts[1:], len(order)) - 1
+    kept = np.unique(np.concatenate([order[bucket_starts], order[bucket_ends]]))
+
+    return positions[kept[np.argsort(x[kept], kind='stable')]]
+
+
+def downsample_lttb(time_vec, values, n_out=2000):
+    """
+    Downsample a time series with Largest-Triangle-Three-Buckets: the first and last points are kept, and from each
+    of n_out - 2 buckets in between, the point that makes the largest triangle with the point kept from the previous
+    bucket and the mean of the next bucket. The shape of the curve (including its peaks) is kept with few points.
+
+    Args:
+        time_vec (array-like): array or list or series of times
+        values (array-like): value at each time (e.g. CGM readings). Missing values are dropped.
+        n_out (int, Optional): number of points to keep, default is 2000
+
+    Returns: (numpy array) sorted positions of the kept points in time_vec
+
+    """
+    x, y, positions = _plot_coordinates(time_vec, values)
+    order = np.argsort(x, kind='stable')
+    x, y, positions = x[order], y[order], positions[order]
+    if len(x) <= n_out or n_out < 3:
+        return positions
+
+    # Bucket edges (positions), splitting the points between the first and the last into n_out - 2 buckets
+    edges = np.linspace(1, len(x) - 1, n_out - 1).astype('int64')
+
+    # Mean point of every bucket, from cumulative sums
+    x_sums = np.concatenate([[0], np.cumsum(x)])
+    y_sums = np.concatenate([[0], np.cumsum(y)])
+    bucket_sizes = np.maximum(np.diff(edges), 1)
+    x_means = (x_sums[edges[1:]] - x_sums[edges[:-1]]) / bucket_sizes
+    y_means = (y_sums[edges[1:]] - y_sums[edges[:-1]]) / bucket_sizes
+
+    kept = np.zeros(n_out, dtype='int64')
+    kept[-1] = len(x) - 1
+    for bucket in range(n_out - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # The next bucket's mean, or the last point after the last bucket
+        next_x = x_means[bucket + 1] if bucket + 1 < n_out - 2 else x[-1]
+        next_y = y_means[bucket + 1] if bucket + 1 < n_out - 2 else y[-1]
+        prev_x, prev_y = x[kept[bucket]], y[kept[bucket]]
+        areas = np.abs((prev_x - next_x) * (y[start:end] - prev_y) - (prev_x - x[start:end]) * (next_y - prev_y))
+        kept[bucket + 1] = start + np.argmax(areas)
+
+    return positions[kept]
+
+
+def bg_trace(time_vec, cgm_data, predicted_times=None, predicted_values=None, max_points=4000, method="minmax",
+             min_target=70, max_target=180, ax=None):
+    """
+    Plot CGM readings (and optionally predicted BG) over time, downsampled so that a long period (e.g. several years
+    of 5 minute readings) is drawn with at most a few thousand points while keeping the highs and lows
+
+    Example usage:
+    fig, ax = bg_trace(df_entries["time"], df_entries["sgv"])
+
+    Args:
+        time_vec (array-like): array or list or series of times
+        cgm_data (array-like): array or list or series of CGM values at each point in time_vec. Must be same length as time_vec
+        predicted_times (array-like, Optional): times of predicted BG values (e.g. loop.predicted.startDate plus 5
+            minutes per step)
+        predicted_values (array-like, Optional): predicted BG at each of predicted_times
+        max_points (int, Optional): most points drawn per series, default is 4000
+        method (str, Optional): "minmax" (lowest and highest point per time bucket) or "lttb" (largest triangle
+            three buckets), default is "minmax"
+        min_target (num, Optional): minimum blood glucose target in mg/dL, default is 70
+        max_target (num, Optional): maximum blood glucose target in mg/dL, default is 180
+        ax (matplotlib axis object, Optional): axis to draw on, default is a new figure
+
+    Returns:
+        A 2-element tuple
+
+        - **fig** (matplotlib figure object)
+        - **ax** (matplotlib axis object)
+    """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    if method == "minmax":
+        downsample = lambda times, values: downsample_minmax(times, values, max_points // 2)
+    elif method == "lttb":
+        downsample = lambda times, values: downsample_lttb(times, values, max_points)
+    else:
+        raise Exception("method must be \"minmax\" or \"lttb\", not " + str(method))
+
+    if ax is None:
+        fig, ax = plt.subplots(1, 1, figsize=(12, 4))
+    else:
+        fig = ax.figure
+
+    ax.axhspan(min_target, max_target, color="cornflowerblue", alpha=0.15, label="target range")
+
+    times = pd.DatetimeIndex(time_vec)
+    cgm_data = np.asarray(cgm_data, dtype='float64')
+    kept = downsample(times, cgm_data)
+    ax.plot(times[kept], cgm_data[kept], color="black", linewidth=0.8, label="CGM")
+
+    if predicted_times is not None and predicted_values is not None:
+        predicted_times = pd.DatetimeIndex(predicted_times)
+        predicted_values = np.asarray(predicted_values, dtype='float64')
+        kept = downsample(predicted_times, predicted_values)
+        ax.plot(predicted_times[kept], predicted_values[kept], color="tomato", linewidth=0.8, alpha=0.7,
+                label="predicted")
+
+    ax.set_ylabel("BG (mg/dL)")
+    ax.legend(ncol=1)
+    sns.despine(ax=ax)
+
+    return fig, ax
@@ -0,0 +1,339 @@
+"""synthetic.py
+Generate realistic, synthetic Nightscout/Loop data (entries, treatments, profile and devicestatus), for testing and
+benchmarking mdb_tools without access to a real database.
+
+Example usage:
+dataset = synthetic.make_dataset("1y")
+df_cgm_daily = oop.daily_cgm_stats(pd.to_datetime(dataset["entries"]["date"], unit='ms', utc=True),
+                                   dataset["entries"]["sgv"])
+
+# Or load it into mongomock (or a local mongod) and use the load_data functions
+db = mongomock.MongoClient().db
+synthetic.load_dataset(db, dataset)
+"""
+import numpy as np
+import pandas as pd
+
+# Number of days of data at each named scale
+SCALES = {
+    "1m": 30,
+    "1y": 365,
+    "5y": 5 * 365,
+}
+
+# Number of points in each Loop glucose prediction (5 minute steps, 6 hours)
+PREDICTION_LENGTH = 72
+
+
+def _iso(times):
+    """
+    Format UTC times the way Nightscout stores them, e.g. "2023-11-04T12:34:56.000Z"
+    """
+    return pd.DatetimeIndex(times).tz_convert('UTC').strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def _utc(start):
+    """
+    Start time as a Timestamp, taking naive times as UTC
+    """
+    start = pd.Timestamp(start)
+
+    return start.tz_localize('UTC') if start.tz is None else start
+
+
+def _cgm_curve(n, rng):
+    """
+    A glucose trace in mg/dL every 5 minutes: a daily rhythm plus smoothed random excursions lasting a few hours
+    """
+    smoothed = np.convolve(rng.normal(0, 1, n + 47), np.hanning(48), mode='valid')
+    excursion = 35 * smoothed / smoothed.std()
+    daily = 25 * np.sin(np.arange(n) * 2 * np.pi / 288)
+
+    return np.clip(np.round(140 + daily + excursion + rng.normal(0, 3, n)), 40, 400)
+
+
+def make_entries(start, days, rng, secondary_fraction=0.3):
+    """
+    CGM entries every 5 minutes from a primary device, with a share of them repeated by a second uploader a few
+    seconds later (as happens when both Loop and the Dexcom app upload)
+
+    Args:
+        start (datetime-like): first reading time (naive times are UTC)
+        days (int): number of days
+        rng (numpy Generator): random number generator
+        secondary_fraction (float, Optional): share of readings that the second device also uploads, default is 0.3
+
+    Returns: pandas dataframe with sgv, dateString, date and device columns (like load_data.get_entries_df())
+
+    """
+    n = days * 288
+    times = pd.date_range(_utc(start), periods=n, freq='5min') + pd.to_timedelta(rng.integers(0, 30, n), unit='s')
+    sgv = _cgm_curve(n, rng)
+
+    # Drop a few readings (sensor warm-ups, signal loss)
+    present = rng.random(n) > 0.01
+    times, sgv = times[present], sgv[present]
+
+    df_primary = pd.DataFrame({'sgv': sgv, 'time': times, 'device': "loop://Dexcom/G6/21.0"})
+    secondary = rng.random(len(df_primary)) < secondary_fraction
+    df_secondary = df_primary[secondary].copy()
+    df_secondary['time'] = df_secondary['time'] + pd.to_timedelta(rng.integers(1, 20, len(df_secondary)), unit='s')
+    df_secondary['device'] = "share2"
+
+    df_entries = pd.concat([df_primary, df_secondary]).sort_values('time', kind='stable')
+
+    return pd.DataFrame({
+        'sgv': df_entries['sgv'].values,
+        'dateString': _iso(df_entries['time']),
+        'date': df_entries['time'].values.astype('datetime64[ms]').astype('int64'),
+        'device': df_entries['device'].values,
+    })
+
+
+def make_treatments(start, days, rng):
+    """
+    Loop treatments: a temp basal every few 5-minute cycles (some of them zero-duration cancels), meal carbs with a
+    bolus, and small automatic correction boluses
+
+    Args:
+        start (datetime-like): start time (naive times are UTC)
+        days (int): number of days
+        rng (numpy Generator): random number generator
+
+    Returns: pandas dataframe with the treatments schema columns (like load_data.get_treatments_df())
+
+    """
+    start = _utc(start)
+
+    # Temp basals, on about one in three Loop cycles
+    cycles = pd.date_range(start, periods=days * 288, freq='5min')
+    temp_times = cycles[rng.random(len(cycles)) < 0.33]
+    n_temp = len(temp_times)
+    temp_times = temp_times + pd.to_timedelta(rng.integers(0, 60, n_temp), unit='s')
+    temp_duration = np.where(rng.random(n_temp) < 0.05, 0.0, 30.0)
+    temp_rate = np.round(rng.gamma(2.0, 0.5, n_temp), 2)
+    df_temp = pd.DataFrame({
+        'time': temp_times, 'eventType': "Temp Basal", 'duration': temp_duration, 'absolute': temp_rate,
+        'rate': temp_rate, 'temp': "absolute", 'automatic': True,
+    })
+
+    # Meals (carbs plus a bolus) at about 7:00, 12:00 and 18:00 UTC, +/- an hour
+    meal_times = (pd.date_range(start.normalize(), periods=days, freq='D').repeat(3) +
+                  pd.to_timedelta(np.tile([7, 12, 18], days), unit='h') +
+                  pd.to_timedelta(rng.integers(-60, 60, days * 3), unit='min'))
+    carbs = np.round(rng.uniform(10, 80, len(meal_times)))
+    df_carbs = pd.DataFrame({
+        'time': meal_times, 'eventType': "Carb Correction", 'carbs': carbs, 'absorptionTime': 180,
+        'foodType': "", 'automatic': False,
+    })
+    meal_bolus = np.round(carbs / 10, 2)
+    df_bolus = pd.DataFrame({
+        'time': meal_times + pd.Timedelta(seconds=30), 'eventType': "Correction Bolus", 'insulin': meal_bolus,
+        'programmed': meal_bolus, 'amount': meal_bolus, 'duration': 0.0, 'automatic': False,
+    })
+
+    # Automatic correction boluses, a few per day
+    smb_times = cycles[rng.random(len(cycles)) < 0.02]
+    smb = np.round(rng.uniform(0.05, 0.5, len(smb_times)), 2)
+    df_smb = pd.DataFrame({
+        'time': smb_times, 'eventType': "Correction Bolus", 'insulin': smb, 'programmed': smb, 'amount': smb,
+        'duration': 0.0, 'automatic': True,
+    })
+
+    df_treatments = pd.concat([df_temp, df_carbs, df_bolus, df_smb]).sort_values('time', kind='stable')
+    df_treatments['timestamp'] = _iso(df_treatments['time'])
+    df_treatments['created_at'] = df_treatments['timestamp']
+    df_treatments['absorptionTime'] = df_treatments['absorptionTime'].astype('Int64')
+
+    columns = ['duration', 'amount', 'absolute', 'foodType', 'carbs', 'absorptionTime', 'insulin', 'programmed',
+               'timestamp', 'created_at', 'rate', 'temp', 'automatic', 'eventType']
+
+    return df_treatments.reindex(columns=columns).reset_index(drop=True)
+
+
+def _schedule(rng, base, spread, slots):
+    """
+    A profile schedule (list of {"time": "HH:MM", "value": x}) starting at midnight
+    """
+    hours = np.concatenate([[0], np.sort(rng.choice(np.arange(1, 24), slots - 1, replace=False))])
+    minutes = np.where(rng.random(slots) < 0.3, 30, 0)
+    minutes[0] = 0
+
+    return [{"time": "%02d:%02d" % (hour, minute), "timeAsSeconds": int(hour * 3600 + minute * 60),
+             "value": float(np.round(base + rng.uniform(-spread, spread), 2))}
+            for hour, minute in zip(hours, minutes)]
+
+
+def make_profiles(start, days, rng, days_between_changes=30, time_zones=("US/Eastern", "US/Pacific")):
+    """
+    Profile documents, with a new one (different schedules) every so often, mostly in the first time zone and
+    occasionally in the others (travel)
+
+    Args:
+        start (datetime-like): time of the first profile (naive times are UTC)
+        days (int): number of days
+        rng (numpy Generator): random number generator
+        days_between_changes (int, Optional): days between profile documents, default is 30
+        time_zones (tuple, Optional): time zones to use, default is ("US/Eastern", "US/Pacific")
+
+    Returns: (list) profile documents
+
+    """
+    start = _utc(start)
+
+    prof_docs = []
+    for change in range(max(1, days // days_between_changes)):
+        change_time = start + pd.Timedelta(days=change * days_between_changes)
+        time_zone = time_zones[0] if rng.random() < 0.8 else time_zones[rng.integers(len(time_zones))]
+        prof_docs.append({
+            "defaultProfile": "Default",
+            "startDate": _iso([change_time])[0],
+            "mills": int(change_time.value // 1_000_000),
+            "units": "mg/dl",
+            "created_at": _iso([change_time])[0],
+            "store": {"Default": {
+                "timezone": time_zone,
+                "units": "mg/dl",
+                "dia": 6,
+                "basal": _schedule(rng, 1.0, 0.4, 5),
+                "carbratio": _schedule(rng, 10, 3, 3),
+                "sens": _schedule(rng, 45, 10, 3),
+                "target_low": [{"time": "00:00", "timeAsSeconds": 0, "value": 100}],
+                "target_high": [{"time": "00:00", "timeAsSeconds": 0, "value": 110}],
+            }},
+        })
+
+    return prof_docs
+
+
+def make_devicestatus(start, days, rng, pod_hours=72, predictions=True):
+    """
+    Loop device statuses every 5 minutes with IOB, COB, an enacted temp basal and (optionally) a glucose prediction,
+    and a "Finish Pairing" pump status at every pod change
+
+    Args:
+        start (datetime-like): first status time (naive times are UTC)
+        days (int): number of days
+        rng (numpy Generator): random number generator
+        pod_hours (num, Optional): hours between pod changes (+/- a few hours), default is 72
+        predictions (bool, Optional): include predicted glucose values, default is True
+
+    Returns: pandas dataframe with flattened columns, like load_data.iter_devicestatus_batches(flatten=True)
+
+    """
+    start = _utc(start)
+    n = days * 288
+    times = pd.date_range(start, periods=n, freq='5min') + pd.to_timedelta(rng.integers(0, 30, n), unit='s')
+
+    # Pod changes every pod_hours, +/- up to 4 hours
+    n_pods = int(days * 24 / pod_hours) + 1
+    pod_changes = (np.arange(n_pods) * pod_hours * 12 + rng.integers(-48, 48, n_pods)).clip(0, n - 1)
+    reservoir = np.full(n, "50+ U", dtype=object)
+    reservoir[np.unique(pod_changes)] = "Finish Pairing"
+
+    df_devicestatus = pd.DataFrame({
+        'created_at': _iso(times),
+        'override.active': rng.random(n) < 0.05,
+        'loop.enacted.duration': 30.0,
+        'loop.enacted.rate': np.round(rng.gamma(2.0, 0.5, n), 2),
+        'loop.enacted.bolusVolume': 0.0,
+        'loop.enacted.received': True,
+        'loop.recommendedBolus': 0.0,
+        'loop.automaticDoseRecommendation.bolusVolume': np.round(rng.uniform(0, 0.3, n), 2),
+        'loop.cob': np.round(np.maximum(rng.normal(10, 15, n), 0), 1),
+        'loop.iob.iob': np.round(rng.gamma(2.0, 0.8, n), 2),
+        'pump.reservoir_display_override': reservoir,
+    })
+
+    if predictions:
+        # Predictions start at the latest glucose and drift away from it
+        first = _cgm_curve(n, rng)
+        drift = np.cumsum(rng.normal(0, 2, (n, PREDICTION_LENGTH)).astype('float32'), axis=1)
+        values = np.clip(first[:, None] + drift, 40, 400).round()
+        df_devicestatus['loop.predicted.startDate'] = df_devicestatus['created_at']
+        df_devicestatus['loop.predicted.values'] = list(values)
+
+    return df_devicestatus
+
+
+def make_dataset(scale="1y", start='2023-01-01', seed=0, predictions=True):
+    """
+    A full synthetic dataset: entries, treatments, profile and devicestatus
+
+    Args:
+        scale (str or int, Optional): "1m", "1y", "5y" (see SCALES) or a number of days, default is "1y"
+        start (datetime-like, Optional): start of the data (naive times are UTC), default is 2023-01-01
+        seed (int, Optional): random seed, default is 0
+        predictions (bool, Optional): include devicestatus glucose predictions, default is True
+
+    Returns: (dict) entries, treatments and devicestatus dataframes, and the list of profile documents
+
+    """
+    days = int(SCALES.get(scale, scale))
+    rng = np.random.default_rng(seed)
+
+    return {
+        "entries": make_entries(start, days, rng),
+        "treatments": make_treatments(start, days, rng),
+        "profile": make_profiles(start, days, rng),
+        "devicestatus": make_devicestatus(start, days, rng, predictions=predictions),
+    }
+
+
+def iter_documents(df, chunk_size=10000):
+    """
+    Turn a flat dataframe (with "parent.child" column names) into nested Mongo documents, a chunk at a time.
+    Missing values are left out of the documents.
+
+    Args:
+        df (dataframe): e.g. one of the dataframes from make_dataset()
+        chunk_size (int, Optional): number of documents per chunk, default is 10000
+
+    Yields: (list) documents
+
+    """
+    paths = [column.split('.') for column in df.columns]
+    for chunk_start in range(0, len(df), chunk_size):
+        chunk = df.iloc[chunk_start:chunk_start + chunk_size]
+        columns = [chunk[column].to_numpy(dtype=object) for column in chunk.columns]
+        docs = []
+        for row in range(len(chunk)):
+            doc = {}
+            for path, values in zip(paths, columns):
+                value = values[row]
+                if value is None or value is pd.NA or (isinstance(value, float) and np.isnan(value)):
+                    continue
+                if isinstance(value, np.ndarray):
+                    value = value.tolist()
+                elif isinstance(value, np.generic):
+                    value = value.item()
+                parent = doc
+                for key in path[:-1]:
+                    parent = parent.setdefault(key, {})
+                parent[path[-1]] = value
+            docs.append(doc)
+        yield docs
+
+
+def load_dataset(db, dataset, chunk_size=10000):
+    """
+    Insert a synthetic dataset into a database (a pymongo or mongomock Database), one collection per item
+
+    Args:
+        db: pymongo (or mongomock) Database
+        dataset (dict): from make_dataset()
+        chunk_size (int, Optional): number of documents per insert, default is 10000
+
+    Returns: (dict) number of documents inserted per collection
+
+    """
+    inserted = {}
+    for name, data in dataset.items():
+        chunks = [data] if isinstance(data, list) else iter_documents(data, chunk_size)
+        inserted[name] = 0
+        for docs in chunks:
+            if len(docs) > 0:
+                db[name].insert_many(docs)
+                inserted[name] += len(docs)
+
+    return inserted